@@ -0,0 +1,160 @@
+'''Base58 and base58check for payloads of any length.
+
+Encoding takes two digits per division, using a table of every two
+character string. Decoding looks characters up in a table instead of
+searching the alphabet. Long inputs, beyond CHUNKED_LENGTH, are converted
+ten digits at a time so the big integer is only divided or multiplied
+once per ten characters; for addresses and keys that bookkeeping costs
+more than it saves.
+'''
+from unittest import TestCase
+
+import hashlib
+
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+# character -> digit value
+BASE58_TABLE = {c: i for i, c in enumerate(BASE58_ALPHABET)}
+# digits per chunk, 58**10 is still below 2**64
+CHUNK_DIGITS = 10
+CHUNK = 58**CHUNK_DIGITS
+# bytes (or characters) from which the chunked conversion is faster
+CHUNKED_LENGTH = 128
+# every two digit string, so a chunk takes 5 divmods instead of 10
+PAIRS = [a + b for a in BASE58_ALPHABET for b in BASE58_ALPHABET]
+
+
+def checksum(s):
+    '''First 4 bytes of hash256'''
+    return hashlib.sha256(hashlib.sha256(s).digest()).digest()[:4]
+
+
+def encode(s):
+    '''Returns the base58 string of the bytes s'''
+    # every leading zero byte is a 1
+    zeros = len(s) - len(s.lstrip(b'\x00'))
+    num = int.from_bytes(s, 'big')
+    chunks = []
+    if len(s) > CHUNKED_LENGTH:
+        while num >= CHUNK:
+            num, chunk = divmod(num, CHUNK)
+            chunks.append(chunk)
+    # num is now the most significant part, which isn't padded
+    result = []
+    while num:
+        num, pair = divmod(num, 3364)
+        result.append(PAIRS[pair])
+    head = ''.join(reversed(result)).lstrip('1')
+    body = []
+    for chunk in reversed(chunks):
+        digits = []
+        for _ in range(CHUNK_DIGITS // 2):
+            chunk, pair = divmod(chunk, 3364)
+            digits.append(PAIRS[pair])
+        body.append(''.join(reversed(digits)))
+    return '1' * zeros + head + ''.join(body)
+
+
+def decode(s):
+    '''Returns the bytes of the base58 string s'''
+    zeros = len(s) - len(s.lstrip('1'))
+    num = 0
+    table = BASE58_TABLE
+    try:
+        if len(s) <= CHUNKED_LENGTH:
+            for c in s:
+                num = num * 58 + table[c]
+            return b'\x00' * zeros + num.to_bytes((num.bit_length() + 7) // 8, 'big')
+        for i in range(0, len(s), CHUNK_DIGITS):
+            chunk = s[i:i + CHUNK_DIGITS]
+            value = 0
+            for c in chunk:
+                value = value * 58 + table[c]
+            num = num * 58**len(chunk) + value
+    except KeyError as e:
+        raise ValueError('{} is not a base58 character'.format(e.args[0]))
+    return b'\x00' * zeros + num.to_bytes((num.bit_length() + 7) // 8, 'big')
+
+
+def encode_check(s):
+    '''Returns the base58check string of s, which has a hash256 checksum'''
+    return encode(s + checksum(s))
+
+
+def decode_check(s):
+    '''Returns the payload of the base58check string s.
+    Raises ValueError if the checksum doesn't match.'''
+    combined = decode(s)
+    payload, check = combined[:-4], combined[-4:]
+    if checksum(payload) != check:
+        raise ValueError('bad checksum: {} {}'.format(check, checksum(payload)))
+    return payload
+
+
+def encode_many(payloads, check=True):
+    '''Encodes every payload, with checksums unless check is False'''
+    if check:
+        return [encode_check(s) for s in payloads]
+    return [encode(s) for s in payloads]
+
+
+def decode_many(strings, check=True):
+    '''Decodes every string, verifying checksums unless check is False'''
+    if check:
+        return [decode_check(s) for s in strings]
+    return [decode(s) for s in strings]
+
+
+class Base58Test(TestCase):
+
+    def test_encode(self):
+        tests = (
+            (b'', ''),
+            (b'\x00', '1'),
+            (b'\x00\x00\x01', '112'),
+            (b'\x39', 'z'),
+            (b'\x3a', '21'),
+            (bytes.fromhex('0000287fb4cd'), '11233QC4'),
+            (b'Hello World!', '2NEpo7TZRRrLZSi2U'),
+        )
+        for raw, want in tests:
+            self.assertEqual(encode(raw), want)
+            self.assertEqual(decode(want), raw)
+
+    def test_chunks(self):
+        # lengths around the chunk boundaries, with and without leading zeros
+        for length in range(0, 300, 7):
+            for raw in (b'\xff' * length, b'\x00\x00' + bytes(i % 256 for i in range(length))):
+                num = int.from_bytes(raw, 'big')
+                digits = ''
+                while num > 0:
+                    num, mod = divmod(num, 58)
+                    digits = BASE58_ALPHABET[mod] + digits
+                want = '1' * (len(raw) - len(raw.lstrip(b'\x00'))) + digits
+                self.assertEqual(encode(raw), want)
+                self.assertEqual(decode(want), raw)
+
+    def test_check(self):
+        # a P2PKH address, a WIF and an xpub
+        tests = (
+            ('6f507b27411ccf7f16f10297de6cef3f291623eddf', 'mnrVtF8DWjMu839VW3rBfgYaAfKk8983Xf'),
+            ('80' + (2**256 - 2**199).to_bytes(32, 'big').hex() + '01', 'L5oLkpV3aqBJ4BgssVAsax1iRa77G5CVYnv9adQ6Z87te7TyUdSC'),
+            ('0488b21e000000000000000000873dff81c02f525623fd1fe5167eac3a55a049de3d314bb42ee227ffed37d5080339a36013301597daef41fbe593a02cc513d0b55527ec2df1050e2e8ff49c85c2',
+             'xpub661MyMwAqRbcFtXgS5sYJABqqG9YLmC4Q1Rdap9gSE8NqtwybGhePY2gZ29ESFjqJoCu1Rupje8YtGqsefD265TMg7usUDFdp6W1EGMcet8'),
+        )
+        for raw, want in tests:
+            raw = bytes.fromhex(raw)
+            self.assertEqual(encode_check(raw), want)
+            self.assertEqual(decode_check(want), raw)
+        with self.assertRaises(ValueError):
+            decode_check('mnrVtF8DWjMu839VW3rBfgYaAfKk8983Xe')
+        with self.assertRaises(ValueError):
+            decode('0OIl')
+
+    def test_many(self):
+        payloads = [bytes([0, i]) * 10 for i in range(20)]
+        strings = encode_many(payloads)
+        self.assertEqual(strings, [encode_check(s) for s in payloads])
+        self.assertEqual(decode_many(strings), payloads)
+        strings = encode_many(payloads, check=False)
+        self.assertEqual(decode_many(strings, check=False), payloads)
@@ -0,0 +1,302 @@
+'''Micro-benchmarks for the hot paths of the library.
+
+Run all of them with `python benchmark.py`, or pick some by name,
+for example `python benchmark.py rmul`.
+'''
+import sys
+
+from random import randint
+from timeit import repeat, timeit
+
+from ecc import (
+    G,
+    N,
+    Point,
+    PrivateKey,
+    S256Point,
+    jacobian_multiply,
+    verify_batch,
+)
+from helper import (
+    encode_varint,
+    hash160,
+    hash256,
+    int_to_little_endian,
+    sha256,
+    SIGHASH_ALL,
+)
+from script import p2pkh_script
+from tx import Tx, TxIn, TxOut
+import base58
+import bloomfilter
+import merkleblock
+import ripemd160
+import schnorr
+
+
+def report(name, seconds, number, baseline=None):
+    '''Prints the time per call in ms and the speedup over baseline'''
+    per_call = seconds / number
+    line = '{:<45}{:>10.3f} ms'.format(name, per_call * 1000)
+    if baseline is not None:
+        line += '{:>8.1f}x'.format(baseline / per_call)
+    print(line)
+    return per_call
+
+
+def bench_rmul(number=20):
+    '''wNAF + GLV scalar multiplication against plain double-and-add'''
+    point = randint(1, N) * G
+    coefficients = [randint(1, N) for _ in range(number)]
+    print('scalar multiplication of an arbitrary point')
+    # the original affine double-and-add from Point
+    seconds = timeit(lambda: [Point.__rmul__(point, c) for c in coefficients], number=1)
+    baseline = report('Point.__rmul__ (affine double-and-add)', seconds, number)
+    seconds = timeit(lambda: [jacobian_multiply(point.jacobian(), c) for c in coefficients], number=1)
+    report('Jacobian double-and-add', seconds, number, baseline)
+    # a fresh point each time pays for its odd multiples
+    fresh = [S256Point(point.x, point.y) for _ in coefficients]
+    seconds = timeit(lambda: [c * p for c, p in zip(coefficients, fresh)], number=1)
+    report('wNAF + GLV, uncached point', seconds, number, baseline)
+    point.odd_multiples()
+    seconds = timeit(lambda: [c * point for c in coefficients], number=1)
+    report('wNAF + GLV, cached point', seconds, number, baseline)
+
+
+def bench_unchecked(number=2000, multiplications=5):
+    '''Point construction with and without the curve check'''
+    point = randint(1, N) * G
+    x, y = point.x, point.y
+    print('building an S256Point from field elements')
+    seconds = timeit(lambda: S256Point(x, y), number=number)
+    checked = report('S256Point(x, y)', seconds, number)
+    seconds = timeit(lambda: S256Point._unchecked(x, y), number=number)
+    report('S256Point._unchecked(x, y)', seconds, number, checked)
+    # the affine double-and-add in Point.__rmul__ builds a new point
+    # for every doubling and addition; time it with those points going
+    # through the checking constructor again, as before _unchecked
+    # the best of a few runs, since the saving is small next to the
+    # inversion in every addition
+    coefficients = [randint(1, N) for _ in range(multiplications)]
+    print('Point.__rmul__ (affine double-and-add), best of 5')
+
+    def run():
+        return min(repeat(lambda: [Point.__rmul__(point, c) for c in coefficients], number=1, repeat=5))
+
+    original = S256Point.__dict__['_unchecked']
+    S256Point._unchecked = classmethod(lambda cls, x, y, a=None, b=None: cls(x, y))
+    try:
+        seconds = run()
+    finally:
+        S256Point._unchecked = original
+    baseline = report('with the curve check', seconds, multiplications)
+    per_call = report('with _unchecked results', run(), multiplications, baseline)
+    print('saved per multiplication: {:.3f} ms'.format((baseline - per_call) * 1000))
+
+
+def bench_verify_batch(number=200):
+    '''verify_batch against one S256Point.verify per signature'''
+    items = []
+    for _ in range(number):
+        private_key = PrivateKey(randint(1, N))
+        z = randint(0, 2**256)
+        # parse the point again so its odd multiples aren't cached yet
+        point = S256Point.parse(private_key.point.sec())
+        items.append((point, z, private_key.sign(z)))
+    print('ECDSA verification, {} distinct keys'.format(number))
+    seconds = timeit(lambda: all(p.verify(z, sig) for p, z, sig in items), number=1)
+    baseline = report('S256Point.verify', seconds, number)
+    fresh = [(S256Point.parse(p.sec()), z, sig) for p, z, sig in items]
+    seconds = timeit(lambda: verify_batch(fresh), number=1)
+    report('verify_batch', seconds, number, baseline)
+
+
+def bench_sign_many(number=200):
+    '''PrivateKey.sign_many against one PrivateKey.sign per message'''
+    private_key = PrivateKey(randint(1, N))
+    zs = [randint(0, 2**256) for _ in range(number)]
+    print('ECDSA signing, {} messages with one key'.format(number))
+    seconds = timeit(lambda: [private_key.sign(z) for z in zs], number=1)
+    baseline = report('PrivateKey.sign', seconds, number)
+    seconds = timeit(lambda: private_key.sign_many(zs), number=1)
+    report('PrivateKey.sign_many', seconds, number, baseline)
+
+
+def bench_schnorr(number=200):
+    '''BIP340 batch verification against one schnorr.verify per signature'''
+    items = []
+    for _ in range(number):
+        private_key = PrivateKey(randint(1, N))
+        msg = randint(0, 2**256).to_bytes(32, 'big')
+        items.append((schnorr.xonly(private_key.point), msg, schnorr.sign(private_key, msg)))
+    print('Schnorr verification, {} distinct keys'.format(number))
+    # the parse cache would hand the second run points with their
+    # odd multiples already computed
+    S256Point.parse_cache.clear()
+    seconds = timeit(lambda: all(schnorr.verify(*item) for item in items), number=1)
+    baseline = report('schnorr.verify', seconds, number)
+    S256Point.parse_cache.clear()
+    seconds = timeit(lambda: schnorr.verify_batch(items), number=1)
+    report('schnorr.verify_batch', seconds, number, baseline)
+
+
+def legacy_encode_base58(s):
+    '''helper.encode_base58 before it moved to the base58 module'''
+    count = 0
+    for c in s:
+        if c == 0:
+            count += 1
+        else:
+            break
+    num = int.from_bytes(s, 'big')
+    prefix = '1' * count
+    result = ''
+    while num > 0:
+        num, mod = divmod(num, 58)
+        result = base58.BASE58_ALPHABET[mod] + result
+    return prefix + result
+
+
+def legacy_decode_base58(s, length):
+    '''helper.decode_base58 before it moved to the base58 module,
+    with the length that used to be fixed at 25 as an argument'''
+    num = 0
+    for c in s:
+        num *= 58
+        num += base58.BASE58_ALPHABET.index(c)
+    combined = num.to_bytes(length, byteorder='big')
+    checksum = combined[-4:]
+    if hash256(combined[:-4])[:4] != checksum:
+        raise ValueError('bad address')
+    return combined[:-4]
+
+
+def bench_base58(number=20000):
+    '''base58check encode/decode of addresses and xpubs'''
+    for name, length in (('addresses', 21), ('xpubs', 78)):
+        payloads = [randint(0, 2**(8 * length)).to_bytes(length, 'big') for _ in range(number)]
+        print('base58check, {} {}'.format(number, name))
+        seconds = timeit(lambda: [legacy_encode_base58(s + hash256(s)[:4]) for s in payloads], number=1)
+        baseline = report('old encode_base58_checksum', seconds, number)
+        seconds = timeit(lambda: base58.encode_many(payloads), number=1)
+        report('base58.encode_many', seconds, number, baseline)
+        strings = base58.encode_many(payloads)
+        seconds = timeit(lambda: [legacy_decode_base58(s, length + 4) for s in strings], number=1)
+        baseline = report('old decode_base58', seconds, number)
+        seconds = timeit(lambda: base58.decode_many(strings), number=1)
+        report('base58.decode_many', seconds, number, baseline)
+
+
+def bench_hash160(number=2000):
+    '''hash160 throughput for 33 byte public keys'''
+    items = [randint(0, 2**264).to_bytes(33, 'big') for _ in range(number)]
+    print('hash160 of {} SEC keys, active backend: {}'.format(number, ripemd160.BACKEND))
+    seconds = timeit(lambda: [ripemd160.python_digest(sha256(s)) for s in items], number=1)
+    report('pure Python RIPEMD-160', seconds, number)
+    seconds = timeit(lambda: [hash160(s) for s in items], number=1)
+    baseline = report('helper.hash160', seconds, number)
+    seconds = timeit(lambda: ripemd160.hash160_many(items), number=1)
+    per_call = report('hash160_many', seconds, number, baseline)
+    print('{:.0f} hash160/sec with hash160_many'.format(1 / per_call))
+
+
+def bench_bloom(number=5000):
+    '''Loading and querying a bloom filter of h160s'''
+    items = [randint(0, 2**160).to_bytes(20, 'big') for _ in range(number)]
+    bf = bloomfilter.BloomFilter.optimal(number, 0.0001)
+    print('bloom filter of {} h160s, {} bytes, {} functions, NumPy: {}'.format(
+        number, bf.size, bf.function_count, bloomfilter.np is not None))
+    seconds = timeit(lambda: [bf.add(item) for item in items], number=1)
+    baseline = report('BloomFilter.add', seconds, number)
+    seconds = timeit(lambda: bf.add_many(items), number=1)
+    report('BloomFilter.add_many', seconds, number, baseline)
+    seconds = timeit(lambda: [bf.contains(item) for item in items], number=1)
+    baseline = report('BloomFilter.contains', seconds, number)
+    seconds = timeit(lambda: bf.contains_many(items), number=1)
+    report('BloomFilter.contains_many', seconds, number, baseline)
+
+
+def bench_merkle(total=4000):
+    '''Checking a proof of every transaction in a full block'''
+    leaves = [randint(0, 2**256).to_bytes(32, 'big') for _ in range(total)]
+    levels = merkleblock.merkle_levels(leaves)
+    hashes, flag_bits = merkleblock.partial_merkle_tree(levels, [True] * total)
+    print('merkle proof of all {} transactions, {} hashes, {} flag bits'.format(
+        total, len(hashes), len(flag_bits)))
+
+    def pop_tree():
+        merkleblock.MerkleTree(total).populate_tree(list(flag_bits), list(hashes))
+
+    seconds = timeit(pop_tree, number=5)
+    baseline = report('MerkleTree.populate_tree', seconds, 5)
+    seconds = timeit(lambda: merkleblock.FlatMerkleTree(total).populate_tree(flag_bits, hashes), number=5)
+    report('FlatMerkleTree.populate_tree', seconds, 5, baseline)
+
+
+def legacy_sig_hash(tx, input_index, redeem_script):
+    '''Tx.sig_hash before SigHashContext, which builds a new TxIn for
+    every input of every preimage'''
+    s = int_to_little_endian(tx.version, 4)
+    s += encode_varint(len(tx.tx_ins))
+    for i, tx_in in enumerate(tx.tx_ins):
+        script_sig = redeem_script if i == input_index else None
+        s += TxIn(tx_in.prev_tx, tx_in.prev_index, script_sig, tx_in.sequence).serialize()
+    s += encode_varint(len(tx.tx_outs))
+    for tx_out in tx.tx_outs:
+        s += tx_out.serialize()
+    s += int_to_little_endian(tx.locktime, 4)
+    s += int_to_little_endian(SIGHASH_ALL, 4)
+    return int.from_bytes(hash256(s), 'big')
+
+
+def bench_sig_hash(inputs=1000):
+    '''Legacy signature hashes of every input of a consolidation'''
+    script_pubkey = p2pkh_script(bytes(20))
+    tx_ins = [TxIn(randint(0, 2**256).to_bytes(32, 'big'), i) for i in range(inputs)]
+    tx = Tx(1, tx_ins, [TxOut(100000, script_pubkey)], 0)
+    print('sig_hash of all {} inputs'.format(inputs))
+    seconds = timeit(lambda: [legacy_sig_hash(tx, i, script_pubkey) for i in range(inputs)], number=1)
+    baseline = report('old Tx.sig_hash', seconds, inputs)
+    seconds = timeit(lambda: [tx.sig_hash(i, script_pubkey) for i in range(inputs)], number=1)
+    report('Tx.sig_hash with SigHashContext', seconds, inputs, baseline)
+
+
+def bench_serialize(inputs=500, number=20):
+    '''Serializing and hashing a signed consolidation'''
+    script_sig = p2pkh_script(bytes(20)) + p2pkh_script(bytes(71))
+    tx_ins = [TxIn(randint(0, 2**256).to_bytes(32, 'big'), i, script_sig) for i in range(inputs)]
+    tx = Tx(1, tx_ins, [TxOut(100000, p2pkh_script(bytes(20)))] * 2, 0)
+    print('serialization of a {} input transaction, {} bytes'.format(inputs, len(tx.serialize())))
+    seconds = timeit(tx.serialize_legacy, number=number)
+    baseline = report('serialize_legacy, repeated +=', seconds, number)
+
+    def fresh():
+        tx.invalidate()
+        return tx.serialized_legacy()
+
+    seconds = timeit(fresh, number=number)
+    report('serialized_legacy, bytearray writer', seconds, number, baseline)
+    seconds = timeit(lambda: tx.hash().hex(), number=number)
+    baseline = report('Tx.hash().hex()', seconds, number)
+    seconds = timeit(tx.id, number=number)
+    report('Tx.id, cached', seconds, number, baseline)
+
+
+BENCHMARKS = {
+    'base58': bench_base58,
+    'bloom': bench_bloom,
+    'hash160': bench_hash160,
+    'merkle': bench_merkle,
+    'rmul': bench_rmul,
+    'schnorr': bench_schnorr,
+    'serialize': bench_serialize,
+    'sig_hash': bench_sig_hash,
+    'sign_many': bench_sign_many,
+    'unchecked': bench_unchecked,
+    'verify_batch': bench_verify_batch,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,40 +1,239 @@
+from math import log
 from unittest import TestCase
 
 from helper import (
-    bit_field_to_bytes,
+    bytes_to_bit_field,
     encode_varint,
     int_to_little_endian,
     murmur3,
 )
 from network import GenericMessage
 
+# NumPy is optional, add_many and contains_many hash batches of
+# equal-length items with it when it's installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 BIP37_CONSTANT = 0xfba4c795
+# what a filter adds for matched outputs, the flag in filterload
+BLOOM_UPDATE_NONE = 0
+BLOOM_UPDATE_ALL = 1
+BLOOM_UPDATE_P2PUBKEY_ONLY = 2
+MAX_BLOOM_FILTER_SIZE = 36000
+MAX_HASH_FUNCS = 50
+# smaller batches aren't worth converting to NumPy arrays
+NUMPY_MIN_BATCH = 16
+
+
+def murmur3_many(items, seeds):
+    '''murmur3 of every item for every seed, vectorized with NumPy.
+    The items all have to be the same length. Returns a
+    len(seeds) x len(items) array of uint32 hashes.'''
+    c1 = np.uint32(0xcc9e2d51)
+    c2 = np.uint32(0x1b873593)
+    length = len(items[0])
+    data = np.frombuffer(b''.join(items), dtype=np.uint8).reshape(len(items), length)
+    rounded_end = length & 0xfffffffc
+    # the k1 values don't depend on the seed, so they're mixed once
+    blocks = data[:, :rounded_end].copy().view('<u4').astype(np.uint32)
+    ks = []
+    for j in range(blocks.shape[1]):
+        k1 = blocks[:, j] * c1
+        k1 = (k1 << np.uint32(15)) | (k1 >> np.uint32(17))
+        ks.append(k1 * c2)
+    tail = None
+    if length & 3:
+        k1 = np.zeros(len(items), dtype=np.uint32)
+        for i in reversed(range(rounded_end, length)):
+            k1 = (k1 << np.uint32(8)) | data[:, i].astype(np.uint32)
+        k1 = k1 * c1
+        k1 = (k1 << np.uint32(15)) | (k1 >> np.uint32(17))
+        tail = k1 * c2
+    result = np.empty((len(seeds), len(items)), dtype=np.uint32)
+    for row, seed in enumerate(seeds):
+        h1 = np.full(len(items), seed & 0xffffffff, dtype=np.uint32)
+        for k1 in ks:
+            h1 ^= k1
+            h1 = (h1 << np.uint32(13)) | (h1 >> np.uint32(19))
+            h1 = h1 * np.uint32(5) + np.uint32(0xe6546b64)
+        if tail is not None:
+            h1 ^= tail
+        h1 ^= np.uint32(length & 0xffffffff)
+        h1 ^= h1 >> np.uint32(16)
+        h1 *= np.uint32(0x85ebca6b)
+        h1 ^= h1 >> np.uint32(13)
+        h1 *= np.uint32(0xc2b2ae35)
+        h1 ^= h1 >> np.uint32(16)
+        result[row] = h1
+    return result
+
+
+def tx_elements(tx):
+    '''The parts of a transaction that BIP0037 matches a filter against,
+    as (txid, outputs, inputs). txid is in hash256 byte order, outputs is
+    a list of (data pushes, whether the script pays to a pubkey or bare
+    multisig) and inputs is a list of (outpoint, data pushes).'''
+    txid = tx.hash()[::-1]
+    outputs = []
+    for tx_out in tx.tx_outs:
+        cmds = tx_out.script_pubkey.cmds
+        data = [cmd for cmd in cmds if type(cmd) == bytes and cmd]
+        # <sec> OP_CHECKSIG or ... OP_CHECKMULTISIG
+        to_pubkey = (len(cmds) == 2 and type(cmds[0]) == bytes and cmds[1] == 0xac) \
+            or (len(cmds) > 3 and cmds[-1] == 0xae)
+        outputs.append((data, to_pubkey))
+    inputs = []
+    for tx_in in tx.tx_ins:
+        outpoint = tx_in.prev_tx[::-1] + int_to_little_endian(tx_in.prev_index, 4)
+        data = [cmd for cmd in tx_in.script_sig.cmds if type(cmd) == bytes and cmd]
+        inputs.append((outpoint, data))
+    return txid, outputs, inputs
 
 
 class BloomFilter:
 
     def __init__(self, size, function_count, tweak):
         self.size = size
-        self.bit_field = [0] * (size * 8)
+        # bit i of the filter is bit i % 8 of byte i // 8
+        self.bits = bytearray(size)
         self.function_count = function_count
         self.tweak = tweak
 
+    @classmethod
+    def optimal(cls, n, fp_rate, tweak=0):
+        '''Returns a filter sized for n items at the given false positive
+        rate, with the formulas and limits from BIP0037'''
+        size = int(-1 / log(2)**2 * n * log(fp_rate) / 8)
+        size = max(1, min(size, MAX_BLOOM_FILTER_SIZE))
+        function_count = int(size * 8 / n * log(2))
+        function_count = max(1, min(function_count, MAX_HASH_FUNCS))
+        return cls(size, function_count, tweak)
+
+    @property
+    def bit_field(self):
+        '''The filter as a list of 0s and 1s'''
+        return bytes_to_bit_field(self.bits)
+
+    def seeds(self):
+        # BIP0037 spec seed is i*BIP37_CONSTANT + self.tweak
+        return [i * BIP37_CONSTANT + self.tweak for i in range(self.function_count)]
+
+    def positions(self, item):
+        '''The bits an item sets'''
+        bit_count = self.size * 8
+        return [murmur3(item, seed=seed) % bit_count for seed in self.seeds()]
+
     def add(self, item):
         '''Add an item to the filter'''
-        # iterate self.function_count number of times
-        for i in range(self.function_count):
-            # BIP0037 spec seed is i*BIP37_CONSTANT + self.tweak
-            seed = i * BIP37_CONSTANT + self.tweak
-            # get the murmur3 hash given that seed
-            h = murmur3(item, seed=seed)
-            # set the bit at the hash mod the bitfield size (self.size*8)
-            bit = h % (self.size * 8)
-            # set the bit field at bit to be 1
-            self.bit_field[bit] = 1
+        bits = self.bits
+        for bit in self.positions(item):
+            bits[bit >> 3] |= 1 << (bit & 7)
+
+    def contains(self, item):
+        '''Whether the item may be in the filter. False positives happen
+        at the rate the filter was sized for, false negatives never.'''
+        bits = self.bits
+        return all(bits[bit >> 3] >> (bit & 7) & 1 for bit in self.positions(item))
+
+    def _batches(self, items):
+        '''Splits items into lists of equal length for NumPy. Yields
+        (indexes, positions) where positions has a row per hash function,
+        or None if that batch should be done item by item.'''
+        by_length = {}
+        for index, item in enumerate(items):
+            by_length.setdefault(len(item), []).append(index)
+        for length, indexes in by_length.items():
+            if np is None or length == 0 or len(indexes) < NUMPY_MIN_BATCH:
+                yield indexes, None
+            else:
+                hashes = murmur3_many([items[i] for i in indexes], self.seeds())
+                yield indexes, hashes.astype(np.int64) % (self.size * 8)
+
+    def add_many(self, items):
+        '''Adds every item in items'''
+        items = [bytes(item) for item in items]
+        for indexes, positions in self._batches(items):
+            if positions is None:
+                for i in indexes:
+                    self.add(items[i])
+                continue
+            bits = np.frombuffer(self.bits, dtype=np.uint8)
+            positions = positions.ravel()
+            masks = np.left_shift(1, positions & 7).astype(np.uint8)
+            np.bitwise_or.at(bits, positions >> 3, masks)
+
+    def _lookup(self, items, batches):
+        '''contains() for items, with positions already split by _batches'''
+        result = [False] * len(items)
+        for indexes, positions in batches:
+            if positions is None:
+                for i in indexes:
+                    result[i] = self.contains(items[i])
+                continue
+            bits = np.frombuffer(self.bits, dtype=np.uint8)
+            found = ((bits[positions >> 3] >> (positions & 7)) & 1).all(axis=0)
+            for i, value in zip(indexes, found.tolist()):
+                result[i] = value
+        return result
+
+    def contains_many(self, items):
+        '''Returns contains(item) for every item in items'''
+        items = [bytes(item) for item in items]
+        return self._lookup(items, self._batches(items))
+
+    def match_elements(self, elements, flag=BLOOM_UPDATE_NONE):
+        '''Returns whether each transaction, given as tx_elements, matches
+        the filter, in block order. A transaction matches if the filter
+        has its txid, a data push in an output or input script, or an
+        outpoint it spends. Depending on flag, the outpoints of matched
+        outputs are added to the filter so later spends match too.'''
+        known = None
+        if np is not None:
+            # hash every item once and look them all up together; when the
+            # filter changes only the lookup is redone
+            items = set()
+            for txid, outputs, inputs in elements:
+                items.add(txid)
+                for data, _ in outputs:
+                    items.update(data)
+                for outpoint, data in inputs:
+                    items.add(outpoint)
+                    items.update(data)
+            items = list(items)
+            batches = list(self._batches(items))
+            known = dict(zip(items, self._lookup(items, batches)))
+        result = []
+        for txid, outputs, inputs in elements:
+            check = self.contains if known is None else known.__getitem__
+            updated = False
+            matched = check(txid)
+            for index, (data, to_pubkey) in enumerate(outputs):
+                if any(check(d) for d in data):
+                    matched = True
+                    if flag == BLOOM_UPDATE_ALL or (flag == BLOOM_UPDATE_P2PUBKEY_ONLY and to_pubkey):
+                        self.add(txid + int_to_little_endian(index, 4))
+                        # the rest of this transaction sees the new bits
+                        check = self.contains
+                        updated = True
+            if not matched:
+                for outpoint, data in inputs:
+                    if check(outpoint) or any(check(d) for d in data):
+                        matched = True
+                        break
+            result.append(matched)
+            if updated and known is not None:
+                known = dict(zip(items, self._lookup(items, batches)))
+        return result
+
+    def match_tx(self, tx, flag=BLOOM_UPDATE_NONE):
+        '''Whether the transaction matches, see match_elements'''
+        return self.match_elements([tx_elements(tx)], flag)[0]
 
     def filter_bytes(self):
-        return bit_field_to_bytes(self.bit_field)
+        return bytes(self.bits)
 
     def filterload(self, flag=1):
         '''Return the filterload message'''
@@ -74,3 +273,43 @@ class BloomFilterTest(TestCase):
         bf.add(item)
         expected = '0a4000600a080000010940050000006300000001'
         self.assertEqual(bf.filterload().serialize().hex(), expected)
+
+    def test_contains(self):
+        bf = BloomFilter(10, 5, 99)
+        bf.add(b'Hello World')
+        self.assertTrue(bf.contains(b'Hello World'))
+        self.assertFalse(bf.contains(b'Goodbye!'))
+        self.assertEqual(bf.bit_field[:16], [0] * 16)
+
+    def test_add_many(self):
+        # h160-sized items go through NumPy when it's installed
+        items = [bytes([i]) * 20 for i in range(40)] + [bytes([i]) * 7 for i in range(40)]
+        bf = BloomFilter(100, 7, 1234)
+        for item in items:
+            bf.add(item)
+        bulk = BloomFilter(100, 7, 1234)
+        bulk.add_many(items[:40])
+        bulk.add_many(items[40:])
+        self.assertEqual(bulk.filter_bytes(), bf.filter_bytes())
+        self.assertEqual(bulk.contains_many(items), [True] * len(items))
+        others = [bytes([i, 1]) * 10 for i in range(40)]
+        self.assertEqual(bulk.contains_many(others), [bulk.contains(item) for item in others])
+
+    def test_murmur3_many(self):
+        if np is None:
+            return
+        for length in (1, 2, 3, 4, 7, 20, 32):
+            items = [bytes((i * 7 + j) % 256 for j in range(length)) for i in range(20)]
+            seeds = [0, 99, 5 * BIP37_CONSTANT + 99]
+            hashes = murmur3_many(items, seeds)
+            for row, seed in enumerate(seeds):
+                self.assertEqual(hashes[row].tolist(), [murmur3(item, seed=seed) for item in items])
+
+    def test_optimal(self):
+        bf = BloomFilter.optimal(1000, 0.0001)
+        self.assertEqual((bf.size, bf.function_count), (2396, 13))
+        # capped at the BIP0037 limits
+        bf = BloomFilter.optimal(10**6, 0.0001)
+        self.assertEqual(bf.size, MAX_BLOOM_FILTER_SIZE)
+        bf = BloomFilter.optimal(1, 10**-30)
+        self.assertEqual(bf.function_count, MAX_HASH_FUNCS)
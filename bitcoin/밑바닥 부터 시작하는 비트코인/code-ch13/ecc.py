@@ -1,11 +1,13 @@
 from io import BytesIO
 from random import randint
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
 import hashlib
 import hmac
+import os
 
-from helper import encode_base58_checksum, hash160
+from helper import LRUCache, encode_base58_checksum, hash160
 
 
 class FieldElement:
@@ -152,6 +154,18 @@ class Point:
             # if not, throw a ValueError
             raise ValueError('({}, {}) is not on the curve'.format(x, y))
 
+    @classmethod
+    def _unchecked(cls, x, y, a, b):
+        '''Builds a point without checking the curve equation.
+        Only for points that come out of curve arithmetic on valid points;
+        anything from outside should go through the constructor.'''
+        point = cls.__new__(cls)
+        point.a = a
+        point.b = b
+        point.x = x
+        point.y = y
+        return point
+
     def __eq__(self, other):
         return self.x == other.x and self.y == other.y \
             and self.a == other.a and self.b == other.b
@@ -193,7 +207,7 @@ class Point:
             s = (other.y - self.y) / (other.x - self.x)
             x = s**2 - self.x - other.x
             y = s * (self.x - x) - self.y
-            return self.__class__(x, y, self.a, self.b)
+            return self.__class__._unchecked(x, y, self.a, self.b)
 
         # Case 4: if we are tangent to the vertical line,
         # we return the point at infinity
@@ -211,7 +225,7 @@ class Point:
             s = (3 * self.x**2 + self.a) / (2 * self.y)
             x = s**2 - 2 * self.x
             y = s * (self.x - x) - self.y
-            return self.__class__(x, y, self.a, self.b)
+            return self.__class__._unchecked(x, y, self.a, self.b)
 
     def __rmul__(self, coefficient):
         coef = coefficient
@@ -240,6 +254,16 @@ class PointTest(TestCase):
         Point(x=3, y=-7, a=5, b=7)
         Point(x=18, y=77, a=5, b=7)
 
+    def test_unchecked(self):
+        # no ValueError, the caller vouches for the point
+        point = Point._unchecked(x=-2, y=4, a=5, b=7)
+        self.assertEqual((point.x, point.y), (-2, 4))
+        # curve arithmetic builds unchecked points of the same class
+        a = Point(x=3, y=7, a=5, b=7)
+        b = Point(x=-1, y=-1, a=5, b=7)
+        self.assertEqual(type(a + b), Point)
+        self.assertEqual(a + b, Point(x=2, y=-5, a=5, b=7))
+
     def test_add0(self):
         a = Point(x=None, y=None, a=5, b=7)
         b = Point(x=2, y=5, a=5, b=7)
@@ -358,6 +382,8 @@ A = 0
 B = 7
 P = 2**256 - 2**32 - 977
 N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
+# how many parsed public keys S256Point.parse remembers
+PARSE_CACHE_SIZE = 4096
 
 
 class S256Field(FieldElement):
@@ -372,6 +398,201 @@ class S256Field(FieldElement):
         return self**((P + 1) // 4)
 
 
+# Jacobian coordinates: the triple (X, Y, Z) of plain integers represents
+# the affine point (X/Z**2, Y/Z**3). Adding and doubling in this form needs
+# no field inversion, so a whole scalar multiplication costs only a single
+# inversion when we convert back to affine at the end.
+# Any triple with Z == 0 is the point at infinity.
+JACOBIAN_INFINITY = (1, 1, 0)
+
+
+def jacobian_double(p):
+    '''Doubles a Jacobian point on secp256k1 (uses a == 0)'''
+    x1, y1, z1 = p
+    if z1 == 0 or y1 == 0:
+        return JACOBIAN_INFINITY
+    yy = y1 * y1 % P
+    s = 4 * x1 * yy % P
+    m = 3 * x1 * x1 % P
+    x3 = (m * m - 2 * s) % P
+    y3 = (m * (s - x3) - 8 * yy * yy) % P
+    z3 = 2 * y1 * z1 % P
+    return (x3, y3, z3)
+
+
+def jacobian_add(p, q):
+    '''Adds two Jacobian points on secp256k1'''
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+    if z1 == 0:
+        return q
+    if z2 == 0:
+        return p
+    z1z1 = z1 * z1 % P
+    z2z2 = z2 * z2 % P
+    u1 = x1 * z2z2 % P
+    u2 = x2 * z1z1 % P
+    s1 = y1 * z2 * z2z2 % P
+    s2 = y2 * z1 * z1z1 % P
+    h = (u2 - u1) % P
+    r = (s2 - s1) % P
+    if h == 0:
+        # same x coordinate, so either the same point or inverses
+        if r == 0:
+            return jacobian_double(p)
+        return JACOBIAN_INFINITY
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - s1 * hhh) % P
+    z3 = h * z1 * z2 % P
+    return (x3, y3, z3)
+
+
+def jacobian_add_affine(p, q):
+    '''Adds a Jacobian point p and an affine point q = (x, y)
+    Cheaper than jacobian_add since q has Z == 1'''
+    x1, y1, z1 = p
+    x2, y2 = q
+    if z1 == 0:
+        return (x2, y2, 1)
+    z1z1 = z1 * z1 % P
+    u2 = x2 * z1z1 % P
+    s2 = y2 * z1 * z1z1 % P
+    h = (u2 - x1) % P
+    r = (s2 - y1) % P
+    if h == 0:
+        if r == 0:
+            return jacobian_double(p)
+        return JACOBIAN_INFINITY
+    hh = h * h % P
+    hhh = h * hh % P
+    v = x1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - y1 * hhh) % P
+    z3 = z1 * h % P
+    return (x3, y3, z3)
+
+
+def jacobian_multiply(p, coefficient):
+    '''Returns coefficient * p using double-and-add in Jacobian coordinates'''
+    coef = coefficient
+    current = p
+    result = JACOBIAN_INFINITY
+    while coef:
+        if coef & 1:
+            result = jacobian_add(result, current)
+        current = jacobian_double(current)
+        coef >>= 1
+    return result
+
+
+# secp256k1 has an efficient endomorphism: (x, y) -> (BETA*x, y) is the
+# same as multiplying the point by LAMBDA, where BETA**3 == 1 mod P
+# and LAMBDA**3 == 1 mod N.
+BETA = 0x7ae96a2b657c07106e64479eac3434e99cf0497512f58995c1396c28719501ee
+LAMBDA = 0x5363ad4cc05c30e0a5261c028812645a122e22ea20816678df02967c1b23bd72
+# short basis of the lattice {(a, b): a + b*LAMBDA == 0 mod N}
+# used to split a scalar into two halves (GLV decomposition)
+GLV_A1 = 0x3086d221a7d46bcde86c90e49284eb15
+GLV_B1 = -0xe4437ed6010e88286f547fa90abfe4c3
+GLV_A2 = 0x114ca50f7a8e2f3f657c1108d9d44cfd8
+GLV_B2 = GLV_A1
+
+
+def jacobian_endomorphism(p):
+    '''Returns LAMBDA * p, which only costs one multiplication by BETA'''
+    x, y, z = p
+    return (BETA * x % P, y, z)
+
+
+def glv_decompose(coefficient):
+    '''Splits coefficient into (k1, k2) with
+    k1 + k2 * LAMBDA == coefficient mod N, where k1 and k2 are
+    signed integers of about 128 bits'''
+    k = coefficient % N
+    # round k * (b2, -b1) / N to the nearest integers
+    c1 = (GLV_B2 * k + N // 2) // N
+    c2 = (-GLV_B1 * k + N // 2) // N
+    k1 = k - c1 * GLV_A1 - c2 * GLV_A2
+    k2 = -c1 * GLV_B1 - c2 * GLV_B2
+    return k1, k2
+
+
+# width of the NAF windows used for points other than G
+WNAF_WIDTH = 5
+
+
+def wnaf(coefficient, width=WNAF_WIDTH):
+    '''Returns the width-w non-adjacent form of coefficient as a list of
+    digits, least significant first. Every non-zero digit is odd and less
+    than 2**(width-1) in absolute value, and any width consecutive digits
+    contain at most one non-zero digit.'''
+    digits = []
+    coef = coefficient
+    while coef:
+        if coef & 1:
+            digit = coef & ((1 << width) - 1)
+            if digit >= 1 << (width - 1):
+                digit -= 1 << width
+            coef -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        coef >>= 1
+    return digits
+
+
+def batch_inverse(values, modulus):
+    '''Returns the inverses of all the values mod a prime modulus using
+    Montgomery's trick: one exponentiation and 3(n-1) multiplications'''
+    values = list(values)
+    # prefix[i] is the product of all the values before i
+    prefix = []
+    acc = 1
+    for value in values:
+        prefix.append(acc)
+        acc = acc * value % modulus
+    if acc == 0:
+        raise ZeroDivisionError('cannot invert 0 mod {}'.format(modulus))
+    # By Fermat's Little Theorem, 1/acc = pow(acc, modulus-2, modulus)
+    inv = pow(acc, modulus - 2, modulus)
+    result = [0] * len(values)
+    for i in reversed(range(len(values))):
+        # inv is now 1/(values[0]*...*values[i])
+        result[i] = inv * prefix[i] % modulus
+        inv = inv * values[i] % modulus
+    return result
+
+
+def jacobian_to_affine(p):
+    '''Returns the affine (x, y) integers of a Jacobian point,
+    or None for the point at infinity'''
+    x, y, z = p
+    if z == 0:
+        return None
+    # this is the only inversion needed
+    z_inv = pow(z, P - 2, P)
+    z_inv2 = z_inv * z_inv % P
+    return (x * z_inv2 % P, y * z_inv2 * z_inv % P)
+
+
+def jacobian_batch_to_affine(points):
+    '''Converts many Jacobian triples to affine (x, y) integers with a
+    single inversion. The point at infinity becomes None'''
+    z_invs = iter(batch_inverse([z for _, _, z in points if z != 0], P))
+    result = []
+    for x, y, z in points:
+        if z == 0:
+            result.append(None)
+            continue
+        z_inv = next(z_invs)
+        z_inv2 = z_inv * z_inv % P
+        result.append((x * z_inv2 % P, y * z_inv2 * z_inv % P))
+    return result
+
+
 class S256Point(Point):
 
     def __init__(self, x, y, a=None, b=None):
@@ -380,6 +601,19 @@ class S256Point(Point):
             super().__init__(x=S256Field(x), y=S256Field(y), a=a, b=b)
         else:
             super().__init__(x=x, y=y, a=a, b=b)
+        # filled in by odd_multiples the first time this point is multiplied
+        self._odd_multiples = None
+
+    # points returned by parse, keyed by SEC bytes
+    parse_cache = LRUCache(PARSE_CACHE_SIZE)
+
+    @classmethod
+    def _unchecked(cls, x, y, a=None, b=None):
+        if type(x) == int:
+            x, y = S256Field(x), S256Field(y)
+        point = super()._unchecked(x, y, S256Field(A), S256Field(B))
+        point._odd_multiples = None
+        return point
 
     def __repr__(self):
         if self.x is None:
@@ -388,10 +622,38 @@ class S256Point(Point):
             return 'S256Point({}, {})'.format(self.x, self.y)
 
     def __rmul__(self, coefficient):
-        coef = coefficient % N
-        return super().__rmul__(coef)
+        # multiples of G come from the precomputed table,
+        # any other point uses wNAF with its cached odd multiples
+        total = multi_scalar_mul([(coefficient, self)])
+        return self.from_jacobian(total)
+
+    def odd_multiples(self):
+        '''Returns [P, 3P, 5P, ... (2**(WNAF_WIDTH-1)-1)P] as affine (x, y).
+        These are the only additions wNAF needs, so they are computed once
+        and kept on the point for every later multiplication.'''
+        if self._odd_multiples is None:
+            precompute_odd_multiples([self])
+        return self._odd_multiples
+
+    def jacobian(self):
+        '''Returns this point as a Jacobian (X, Y, Z) triple of integers'''
+        if self.x is None:
+            return JACOBIAN_INFINITY
+        return (self.x.num, self.y.num, 1)
+
+    @classmethod
+    def from_jacobian(cls, p):
+        '''Converts a Jacobian triple back to an affine point of this class'''
+        affine = jacobian_to_affine(p)
+        if affine is None:
+            return cls(None, None)
+        # the result of arithmetic on valid points is on the curve
+        return cls._unchecked(*affine)
 
     def verify(self, z, sig):
+        # r and s have to be between 1 and N-1, as in verify_batch
+        if not (0 < sig.r < N and 0 < sig.s < N):
+            return False
         # By Fermat's Little Theorem, 1/s = pow(s, N-2, N)
         s_inv = pow(sig.s, N - 2, N)
         # u = z / s
@@ -399,8 +661,13 @@ class S256Point(Point):
         # v = r / s
         v = sig.r * s_inv % N
         # u*G + v*P should have as the x coordinate, r
-        total = u * G + v * self
-        return total.x.num == sig.r
+        # the sum stays in Jacobian coordinates,
+        # so the only inversion happens when we read off x
+        total = multi_scalar_mul([(u, G), (v, self)])
+        affine = jacobian_to_affine(total)
+        if affine is None:
+            return False
+        return affine[0] == sig.r
 
     def sec(self, compressed=True):
         '''returns the binary version of the SEC format'''
@@ -430,8 +697,20 @@ class S256Point(Point):
         return encode_base58_checksum(prefix + h160)
 
     @classmethod
-    def parse(self, sec_bin):
+    def parse(cls, sec_bin):
         '''returns a Point object from a SEC binary (not hex)'''
+        # the same keys show up over and over in a block, and a compressed
+        # key costs a square root, so validated points are kept by SEC bytes
+        key = bytes(sec_bin)
+        point = cls.parse_cache.get(key)
+        if point is None:
+            point = cls._parse(key)
+            cls.parse_cache.put(key, point)
+        return point
+
+    @classmethod
+    def _parse(self, sec_bin):
+        '''parses a SEC binary without looking at parse_cache'''
         if sec_bin[0] == 4:
             x = int.from_bytes(sec_bin[1:33], 'big')
             y = int.from_bytes(sec_bin[33:65], 'big')
@@ -459,6 +738,110 @@ G = S256Point(
     0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8)
 
 
+class GeneratorTable:
+    '''Fixed-window precomputation for multiples of G.
+    Row i holds the affine points j * 2**(window*i) * G for
+    j = 1 .. 2**window - 1, so coefficient * G is one table lookup
+    and one mixed addition per window, with no doublings at all.
+    The table is built on first use and can be saved to disk.'''
+    window = 4
+    rows = None
+
+    @classmethod
+    def get_rows(cls):
+        if cls.rows is None:
+            cls.rows = cls.build(cls.window)
+        return cls.rows
+
+    @classmethod
+    def build(cls, window):
+        rows = []
+        base = G.jacobian()
+        for _ in range((256 + window - 1) // window):
+            # successive multiples base, 2*base, ... (2**window-1)*base
+            multiples = [base]
+            for _ in range(2**window - 2):
+                multiples.append(jacobian_add(multiples[-1], base))
+            rows.append(multiples)
+            # next row starts at 2**window * base
+            base = jacobian_add(multiples[-1], base)
+        # convert the whole table to affine with one inversion
+        row_size = 2**window - 1
+        affine = jacobian_batch_to_affine([m for row in rows for m in row])
+        return [affine[i:i + row_size] for i in range(0, len(affine), row_size)]
+
+    @classmethod
+    def multiply(cls, coefficient):
+        '''Returns coefficient * G as a Jacobian triple'''
+        rows = cls.get_rows()
+        mask = 2**cls.window - 1
+        coef = coefficient % N
+        result = JACOBIAN_INFINITY
+        for row in rows:
+            if coef == 0:
+                break
+            digit = coef & mask
+            if digit:
+                result = jacobian_add_affine(result, row[digit - 1])
+            coef >>= cls.window
+        return result
+
+    @classmethod
+    def load_cache(cls, filename):
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        window = raw[0]
+        if window == 0:
+            raise ValueError('bad generator table window: 0')
+        num_rows = (256 + window - 1) // window
+        row_size = 2**window - 1
+        if len(raw) != 1 + num_rows * row_size * 64:
+            raise ValueError('bad generator table size: {}'.format(len(raw)))
+        rows = []
+        offset = 1
+        for _ in range(num_rows):
+            row = []
+            for _ in range(row_size):
+                x = int.from_bytes(raw[offset:offset + 32], 'big')
+                y = int.from_bytes(raw[offset + 32:offset + 64], 'big')
+                row.append((x, y))
+                offset += 64
+            rows.append(row)
+        # a table of other points, even valid ones, would silently produce
+        # wrong keys, so every point is checked against the one before it
+        cls.check(rows)
+        cls.window = window
+        cls.rows = rows
+
+    @staticmethod
+    def check(rows):
+        '''Raises ValueError unless rows starts at G, entry j of each row is
+        (j+1) times its entry 0 and each row starts at 2**window times the
+        previous row's entry 0. One mixed addition per entry, no inversions.'''
+
+        def equal(jacobian, affine):
+            x1, y1, z1 = jacobian
+            x2, y2 = affine
+            zz = z1 * z1 % P
+            return z1 != 0 and x1 == x2 * zz % P and y1 == y2 * zz * z1 % P
+
+        expected = G.jacobian()
+        for row in rows:
+            base = row[0]
+            for point in row:
+                if not equal(expected, point):
+                    raise ValueError('generator table point is wrong')
+                expected = jacobian_add_affine(expected, base)
+
+    @classmethod
+    def dump_cache(cls, filename):
+        with open(filename, 'wb') as f:
+            f.write(bytes([cls.window]))
+            for row in cls.get_rows():
+                for x, y in row:
+                    f.write(x.to_bytes(32, 'big') + y.to_bytes(32, 'big'))
+
+
 class S256Test(TestCase):
 
     def test_order(self):
@@ -482,6 +865,22 @@ class S256Test(TestCase):
             # check that the secret*G is the same as the point
             self.assertEqual(secret * G, point)
 
+    def test_parse_cache(self):
+        sec = (1485 * G).sec()
+        S256Point.parse_cache.clear()
+        point = S256Point.parse(sec)
+        self.assertEqual((S256Point.parse_cache.hits, S256Point.parse_cache.misses), (0, 1))
+        # the second parse returns the same validated point
+        self.assertIs(S256Point.parse(bytearray(sec)), point)
+        self.assertEqual((S256Point.parse_cache.hits, S256Point.parse_cache.misses), (1, 1))
+        self.assertEqual(point, 1485 * G)
+
+    def test_parse_invalid(self):
+        # points from outside are still checked
+        sec = (7 * G).sec(compressed=False)
+        with self.assertRaises(ValueError):
+            S256Point.parse(sec[:-1] + bytes([sec[-1] ^ 1]))
+
     def test_verify(self):
         point = S256Point(
             0x887387e452b8eacc4acfde10d9aaf7f6d9a0f975aabb10d006e4da568744d06c,
@@ -542,6 +941,309 @@ class S256Test(TestCase):
             point.address(compressed=False, testnet=True), testnet_address)
 
 
+class BatchInverseTest(TestCase):
+
+    def test_batch_inverse(self):
+        for modulus in (P, N, 223):
+            values = [randint(1, modulus - 1) for _ in range(10)]
+            want = [pow(v, modulus - 2, modulus) for v in values]
+            self.assertEqual(batch_inverse(values, modulus), want)
+        self.assertEqual(batch_inverse([], P), [])
+        with self.assertRaises(ZeroDivisionError):
+            batch_inverse([3, 0, 5], 223)
+
+    def test_batch_to_affine(self):
+        points = [jacobian_double((1485 * G).jacobian()), (7 * G).jacobian(), JACOBIAN_INFINITY]
+        want = [jacobian_to_affine(p) for p in points]
+        self.assertEqual(jacobian_batch_to_affine(points), want)
+
+
+class JacobianTest(TestCase):
+
+    def test_double(self):
+        # G + G using the affine formulas from Point
+        want = G + G
+        self.assertEqual(S256Point.from_jacobian(jacobian_double(G.jacobian())), want)
+        # doubling with Z != 1 should give the same point
+        z = 0x1234567
+        scaled = (G.x.num * z * z % P, G.y.num * z * z * z % P, z)
+        self.assertEqual(S256Point.from_jacobian(jacobian_double(scaled)), want)
+
+    def test_add(self):
+        p1 = 1485 * G
+        p2 = 2**128 * G
+        want = p1 + p2
+        self.assertEqual(S256Point.from_jacobian(jacobian_add(p1.jacobian(), p2.jacobian())), want)
+        # adding a point to itself doubles it
+        self.assertEqual(S256Point.from_jacobian(jacobian_add(p1.jacobian(), p1.jacobian())), p1 + p1)
+        # adding a point to its inverse is the point at infinity
+        neg = S256Point(p1.x.num, P - p1.y.num)
+        self.assertIsNone(S256Point.from_jacobian(jacobian_add(p1.jacobian(), neg.jacobian())).x)
+        self.assertEqual(jacobian_add(JACOBIAN_INFINITY, p1.jacobian()), p1.jacobian())
+
+
+def precompute_odd_multiples(points):
+    '''Fills in the cached odd multiples of all the points, converting
+    them to affine with a single inversion shared by every point'''
+    todo = []
+    seen = set()
+    for point in points:
+        if point._odd_multiples is None and id(point) not in seen \
+                and point.jacobian()[2] != 0:
+            seen.add(id(point))
+            todo.append(point)
+    if not todo:
+        return
+    size = 2**(WNAF_WIDTH - 2)
+    jacobians = []
+    for point in todo:
+        p = point.jacobian()
+        double = jacobian_double(p)
+        multiples = [p]
+        for _ in range(size - 1):
+            multiples.append(jacobian_add(multiples[-1], double))
+        jacobians.extend(multiples)
+    affine = jacobian_batch_to_affine(jacobians)
+    for i, point in enumerate(todo):
+        point._odd_multiples = affine[i * size:(i + 1) * size]
+
+
+def multi_scalar_mul(terms):
+    '''Returns the sum of coefficient * point over the (coefficient, point)
+    pairs in terms, as a Jacobian triple.
+    Multiples of G come from GeneratorTable. Every other coefficient is
+    split in two ~128-bit halves with the GLV endomorphism,
+    k*P = k1*P + k2*(LAMBDA*P), and all the halves are recoded in wNAF
+    and share a single doubling chain (interleaved Strauss-Shamir).
+    So u*P1 + v*P2 costs about 128 doublings in total.'''
+    result = JACOBIAN_INFINITY
+    others = []
+    g = G.jacobian()
+    for coefficient, point in terms:
+        coef = coefficient % N
+        p = point.jacobian()
+        if coef == 0 or p[2] == 0:
+            continue
+        if p == g:
+            result = jacobian_add(result, GeneratorTable.multiply(coef))
+        else:
+            others.append((coef, point))
+    # one inversion for the odd multiples of all the points
+    precompute_odd_multiples([point for _, point in others])
+    chain = []
+    for coef, point in others:
+        multiples = point.odd_multiples()
+        # LAMBDA * (x, y) == (BETA * x, y)
+        endo_multiples = [(BETA * x % P, y) for x, y in multiples]
+        for k, table in zip(glv_decompose(coef), (multiples, endo_multiples)):
+            if k < 0:
+                # -k * P == k * (-P)
+                k = -k
+                table = [(x, P - y) for x, y in table]
+            chain.append((wnaf(k), table))
+    if not chain:
+        return result
+    total = JACOBIAN_INFINITY
+    for i in reversed(range(max(len(digits) for digits, _ in chain))):
+        total = jacobian_double(total)
+        for digits, multiples in chain:
+            if i >= len(digits):
+                continue
+            digit = digits[i]
+            if digit > 0:
+                total = jacobian_add_affine(total, multiples[digit >> 1])
+            elif digit < 0:
+                x, y = multiples[-digit >> 1]
+                total = jacobian_add_affine(total, (x, P - y))
+    return jacobian_add(result, total)
+
+
+def verify_batch(items):
+    '''Verifies many (point, z, Signature) triples at once.
+    Returns True only if every signature is valid, with the same
+    result as calling point.verify(z, sig) on each of them.
+    Anything after the triple in an item, like the SEC and DER bytes
+    that op_checksig adds in batch mode, is ignored.'''
+    items = [item[:3] for item in items]
+    for _, _, sig in items:
+        # the same range as S256Point.verify. s has to be invertible for
+        # the batch inversion below, and r < N < P keeps the comparison
+        # below from accepting r + P
+        if not (0 < sig.r < N and 0 < sig.s < N):
+            return False
+    # one exponentiation inverts every s
+    s_invs = batch_inverse([sig.s for _, _, sig in items], N)
+    # and one more gives the odd multiples of every pubkey
+    precompute_odd_multiples([point for point, _, _ in items])
+    for (point, z, sig), s_inv in zip(items, s_invs):
+        u = z * s_inv % N
+        v = sig.r * s_inv % N
+        x, _, z3 = multi_scalar_mul([(u, G), (v, point)])
+        # x/z**2 == r is the same as x == r*z**2, so no signature in
+        # the batch needs an inversion to get its affine x
+        if z3 == 0 or x != sig.r * z3 * z3 % P:
+            return False
+    return True
+
+
+def first_invalid(items):
+    '''Returns the index of the first item in items whose signature
+    doesn't verify, or None if they all do.
+    The whole batch goes through verify_batch first, so the items are
+    only checked one at a time when something in there is bad.'''
+    if verify_batch(items):
+        return None
+    for i, item in enumerate(items):
+        point, z, sig = item[:3]
+        if not point.verify(z, sig):
+            return i
+
+
+class GeneratorTableTest(TestCase):
+
+    def test_multiply(self):
+        secrets = (0, 1, 7, 1485, 2**128, 2**240 + 2**31, N - 1)
+        for secret in secrets:
+            want = jacobian_to_affine(jacobian_multiply(G.jacobian(), secret))
+            self.assertEqual(jacobian_to_affine(GeneratorTable.multiply(secret)), want)
+
+    def test_cache(self):
+        rows = GeneratorTable.get_rows()
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'g.table')
+            GeneratorTable.dump_cache(filename)
+            GeneratorTable.rows = None
+            GeneratorTable.load_cache(filename)
+        self.assertEqual(GeneratorTable.rows, rows)
+        # valid points in the wrong places
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'g.table')
+            GeneratorTable.dump_cache(filename)
+            with open(filename, 'rb') as f:
+                raw = bytearray(f.read())
+            swapped = raw[:1] + raw[65:129] + raw[1:65] + raw[129:]
+            for bad in (swapped, b'\x00' + raw[1:]):
+                with open(filename, 'wb') as f:
+                    f.write(bad)
+                with self.assertRaises(ValueError):
+                    GeneratorTable.load_cache(filename)
+        self.assertEqual(GeneratorTable.rows, rows)
+
+
+class WnafTest(TestCase):
+
+    def test_wnaf(self):
+        for coefficient in (1, 7, 1485, 2**128, 2**240 + 2**31, N - 1, randint(1, N)):
+            for width in (2, 4, 5):
+                digits = wnaf(coefficient, width)
+                self.assertEqual(sum(d << i for i, d in enumerate(digits)), coefficient)
+                for i, digit in enumerate(digits):
+                    if digit:
+                        self.assertEqual(digit % 2, 1)
+                        self.assertLess(abs(digit), 2**(width - 1))
+                        # the next width-1 digits are all zero
+                        self.assertEqual(digits[i + 1:i + width], [0] * len(digits[i + 1:i + width]))
+
+    def test_rmul(self):
+        point = 1485 * G
+        for coefficient in (1, 2, 15, 16, 2**128, N - 1, randint(1, N)):
+            want = jacobian_to_affine(jacobian_multiply(point.jacobian(), coefficient))
+            self.assertEqual(jacobian_to_affine((coefficient * point).jacobian()), want)
+        # the odd multiples are cached on the point
+        self.assertIs(point.odd_multiples(), point.odd_multiples())
+        want = [jacobian_to_affine(jacobian_multiply(point.jacobian(), k)) for k in range(1, 16, 2)]
+        self.assertEqual(point.odd_multiples(), want)
+
+
+class GlvTest(TestCase):
+
+    def test_endomorphism(self):
+        want = jacobian_to_affine(jacobian_multiply(G.jacobian(), LAMBDA))
+        self.assertEqual(jacobian_to_affine(jacobian_endomorphism(G.jacobian())), want)
+
+    def test_decompose(self):
+        # the secrets from S256Test.test_pubpoint
+        points = (
+            (7, 0x5cbdf0646e5db4eaa398f365f2ea7a0e3d419b7e0330e39ce92bddedcac4f9bc, 0x6aebca40ba255960a3178d6d861a54dba813d0b813fde7b5a5082628087264da),
+            (1485, 0xc982196a7466fbbbb0e27a940b6af926c1a74d5ad07128c82824a11b5398afda, 0x7a91f9eae64438afb9ce6448a1c133db2d8fb9254e4546b6f001637d50901f55),
+            (2**128, 0x8f68b9d2f63b5f339239c1ad981f162ee88c5678723ea3351b7b444c9ec4c0da, 0x662a9f2dba063986de1d90c2b6be215dbbea2cfe95510bfdf23cbf79501fff82),
+            (2**240 + 2**31, 0x9577ff57c8234558f293df502ca4f09cbc65a6572c842b39b366f21717945116, 0x10b49c67fa9365ad7b90dab070be339a1daf9052373ec30ffae4f72d5e66d053),
+        )
+        for secret, x, y in points:
+            k1, k2 = glv_decompose(secret)
+            self.assertEqual((k1 + k2 * LAMBDA) % N, secret)
+            self.assertLess(abs(k1), 2**129)
+            self.assertLess(abs(k2), 2**129)
+            # k1*G + k2*(LAMBDA*G) is the public point
+            g = G.jacobian()
+            total = jacobian_add(
+                jacobian_multiply(g, k1 % N),
+                jacobian_multiply(jacobian_endomorphism(g), k2 % N))
+            self.assertEqual(jacobian_to_affine(total), (x, y))
+            # multiplying a point other than G goes through the decomposition
+            q = 3 * G
+            self.assertEqual(secret * q, (3 * secret) * G)
+        for _ in range(20):
+            k = randint(0, N)
+            k1, k2 = glv_decompose(k)
+            self.assertEqual((k1 + k2 * LAMBDA) % N, k % N)
+            self.assertLess(abs(k1), 2**129)
+            self.assertLess(abs(k2), 2**129)
+
+
+class MultiScalarMulTest(TestCase):
+
+    def test_multi_scalar_mul(self):
+        p1 = 1485 * G
+        p2 = (2**240 + 2**31) * G
+        infinity = S256Point(None, None)
+        tests = (
+            [(7, G)],
+            [(2**128, p1)],
+            [(7, G), (2**128, p1)],
+            [(N - 1, p1), (12345, p2), (2**200, G)],
+            [(0, p1), (3, p2), (5, infinity)],
+            [(1, p1), (N - 1, p1)],
+            [],
+        )
+        for terms in tests:
+            want = JACOBIAN_INFINITY
+            for coefficient, point in terms:
+                want = jacobian_add(want, jacobian_multiply(point.jacobian(), coefficient))
+            got = multi_scalar_mul(terms)
+            self.assertEqual(jacobian_to_affine(got), jacobian_to_affine(want))
+
+
+class VerifyBatchTest(TestCase):
+
+    def test_verify_batch(self):
+        items = []
+        for secret in (7, 1485, 2**128, 2**240 + 2**31):
+            pk = PrivateKey(secret)
+            for _ in range(3):
+                z = randint(0, 2**256)
+                items.append((pk.point, z, pk.sign(z)))
+        self.assertTrue(verify_batch(items))
+        self.assertTrue(verify_batch([]))
+        # a wrong z in the middle of the batch
+        point, z, sig = items[5]
+        bad = items[:5] + [(point, z + 1, sig)] + items[6:]
+        self.assertFalse(verify_batch(bad))
+        # s out of range
+        bad = items[:5] + [(point, z, Signature(sig.r, 0))] + items[6:]
+        self.assertFalse(verify_batch(bad))
+        self.assertIsNone(first_invalid(items))
+        self.assertIsNone(first_invalid([]))
+        self.assertEqual(first_invalid(bad), 5)
+        self.assertEqual(first_invalid(bad + bad), 5)
+        for point, z, sig in items:
+            self.assertTrue(point.verify(z, sig))
+        # r + P and s + N are congruent but out of range, so both reject them
+        for bad_sig in (Signature(sig.r + P, sig.s), Signature(sig.r, sig.s + N)):
+            self.assertFalse(point.verify(z, bad_sig))
+            self.assertFalse(verify_batch([(point, z, bad_sig)]))
+
+
 class Signature:
 
     def __init__(self, r, s):
@@ -620,7 +1322,7 @@ class PrivateKey:
     def sign(self, z):
         k = self.deterministic_k(z)
         # r is the x coordinate of the resulting point k*G
-        r = (k * G).x.num
+        r = jacobian_to_affine(GeneratorTable.multiply(k))[0]
         # remember 1/k = pow(k, N-2, N)
         k_inv = pow(k, N - 2, N)
         # s = (z+r*secret) / k
@@ -631,6 +1333,21 @@ class PrivateKey:
         # Signature(r, s)
         return Signature(r, s)
 
+    def sign_many(self, zs):
+        '''Signs every z in zs, giving the same signatures as sign.
+        All the k*G points share one batch normalization and all the
+        k values share one batch inversion.'''
+        ks = [self.deterministic_k(z) for z in zs]
+        points = jacobian_batch_to_affine([GeneratorTable.multiply(k) for k in ks])
+        k_invs = batch_inverse(ks, N)
+        sigs = []
+        for z, (r, _), k_inv in zip(zs, points, k_invs):
+            s = (z + r * self.secret) * k_inv % N
+            if s > N / 2:
+                s = N - s
+            sigs.append(Signature(r, s))
+        return sigs
+
     def deterministic_k(self, z):
         k = b'\x00' * 32
         v = b'\x01' * 32
@@ -676,6 +1393,13 @@ class PrivateKeyTest(TestCase):
         sig = pk.sign(z)
         self.assertTrue(pk.point.verify(z, sig))
 
+    def test_sign_many(self):
+        pk = PrivateKey(randint(0, N))
+        zs = [randint(0, 2**256) for _ in range(5)]
+        sigs = pk.sign_many(zs)
+        self.assertEqual([sig.der() for sig in sigs], [pk.sign(z).der() for z in zs])
+        self.assertEqual(pk.sign_many([]), [])
+
     def test_wif(self):
         pk = PrivateKey(2**256 - 2**199)
         expected = 'L5oLkpV3aqBJ4BgssVAsax1iRa77G5CVYnv9adQ6Z87te7TyUdSC'
@@ -689,3 +1413,4 @@ class PrivateKeyTest(TestCase):
         pk = PrivateKey(0x1cca23de92fd1862fb5b76e5f4f50eb082165e5191e116c18ed1a6b24be6a53f)
         expected = 'cNYfWuhDpbNM1JWc3c6JTrtrFVxU4AGhUKgw5f93NP2QaBqmxKkg'
         self.assertEqual(pk.wif(compressed=True, testnet=True), expected)
+
@@ -0,0 +1,325 @@
+'''BIP32 hierarchical deterministic keys.
+
+HDPrivateKey wraps an ecc.PrivateKey and HDPublicKey wraps an S256Point,
+each with the chain code and position in the tree. Only non-hardened
+children can be derived from an HDPublicKey, which is all a watch-only
+server needs to hand out receive addresses.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from unittest import TestCase
+
+import hashlib
+import hmac
+
+from ecc import (
+    N,
+    GeneratorTable,
+    PrivateKey,
+    S256Point,
+    jacobian_add,
+    jacobian_batch_to_affine,
+)
+from helper import (
+    LRUCache,
+    decode_base58_checksum,
+    encode_base58_checksum,
+    hash160,
+)
+
+
+HARDENED = 0x80000000
+# how many derived nodes derive remembers
+NODE_CACHE_SIZE = 1024
+# how many children derive_range gives a worker at a time
+DERIVE_CHUNK_SIZE = 256
+
+XPRV = {False: bytes.fromhex('0488ade4'), True: bytes.fromhex('04358394')}
+XPUB = {False: bytes.fromhex('0488b21e'), True: bytes.fromhex('043587cf')}
+
+
+def parse_path(path):
+    '''Turns a path like "m/44'/0'/0'/0" into a list of child numbers.
+    ', h and H all mean hardened.'''
+    parts = path.split('/')
+    if parts[0] != 'm':
+        raise ValueError('path has to start with m: {}'.format(path))
+    indices = []
+    for part in parts[1:]:
+        if part[-1] in "'hH":
+            indices.append(int(part[:-1]) + HARDENED)
+        else:
+            indices.append(int(part))
+        if not 0 <= indices[-1] < 2**32:
+            raise ValueError('bad child number {} in {}'.format(part, path))
+    return indices
+
+
+class HDPublicKey:
+
+    def __init__(self, point, chain_code, depth=0, parent_fingerprint=b'\x00' * 4,
+                 child_number=0, testnet=False):
+        self.point = point
+        self.chain_code = chain_code
+        self.depth = depth
+        self.parent_fingerprint = parent_fingerprint
+        self.child_number = child_number
+        self.testnet = testnet
+        # the nodes derive found below this one, keyed by their path
+        self.node_cache = LRUCache(NODE_CACHE_SIZE)
+
+    def __repr__(self):
+        return self.serialize()
+
+    def __eq__(self, other):
+        return self.serialize() == other.serialize()
+
+    def fingerprint(self):
+        return hash160(self.point.sec())[:4]
+
+    def address(self):
+        return self.point.address(testnet=self.testnet)
+
+    def key_bytes(self):
+        return self.point.sec()
+
+    def version(self):
+        return XPUB[self.testnet]
+
+    def serialize(self):
+        '''Returns the xpub (or tpub) string'''
+        raw = self.version()
+        raw += bytes([self.depth])
+        raw += self.parent_fingerprint
+        raw += self.child_number.to_bytes(4, 'big')
+        raw += self.chain_code
+        raw += self.key_bytes()
+        return encode_base58_checksum(raw)
+
+    @classmethod
+    def parse(cls, s):
+        '''Returns an HDPublicKey or HDPrivateKey from an extended key string'''
+        raw = decode_base58_checksum(s)
+        if len(raw) != 78:
+            raise ValueError('extended keys are 78 bytes, not {}'.format(len(raw)))
+        stream = BytesIO(raw)
+        version = stream.read(4)
+        depth = stream.read(1)[0]
+        parent_fingerprint = stream.read(4)
+        child_number = int.from_bytes(stream.read(4), 'big')
+        chain_code = stream.read(32)
+        key = stream.read(33)
+        for testnet in (False, True):
+            if version == XPUB[testnet]:
+                point = S256Point.parse(key)
+                return HDPublicKey(point, chain_code, depth, parent_fingerprint, child_number, testnet)
+            if version == XPRV[testnet]:
+                if key[0] != 0:
+                    raise ValueError('bad private key prefix {:x}'.format(key[0]))
+                private_key = PrivateKey(int.from_bytes(key[1:], 'big'))
+                return HDPrivateKey(private_key, chain_code, depth, parent_fingerprint, child_number, testnet)
+        raise ValueError('unknown version {}'.format(version.hex()))
+
+    def tweak(self, data, index):
+        '''Returns (IL, IR), the halves of the HMAC-SHA512 for a child'''
+        h = hmac.new(self.chain_code, data + index.to_bytes(4, 'big'), hashlib.sha512).digest()
+        il = int.from_bytes(h[:32], 'big')
+        if il >= N:
+            # happens with probability 2**-127, BIP32 says to use the next index
+            raise ValueError('invalid child {}, use the next index'.format(index))
+        return il, h[32:]
+
+    def children(self, start, count):
+        '''Returns the children start to start+count-1. The parent's SEC
+        is computed once and all the child points share one inversion.'''
+        if start + count > HARDENED:
+            raise ValueError('hardened children need the private key')
+        sec = self.point.sec()
+        fingerprint = hash160(sec)[:4]
+        p = self.point.jacobian()
+        tweaks = [self.tweak(sec, index) for index in range(start, start + count)]
+        # child point = IL*G + parent point
+        jacobians = [jacobian_add(GeneratorTable.multiply(il), p) for il, _ in tweaks]
+        result = []
+        for index, (_, chain_code), affine in zip(range(start, start + count), tweaks, jacobian_batch_to_affine(jacobians)):
+            if affine is None:
+                raise ValueError('invalid child {}, use the next index'.format(index))
+            point = S256Point._unchecked(*affine)
+            result.append(HDPublicKey(point, chain_code, self.depth + 1, fingerprint, index, self.testnet))
+        return result
+
+    def child(self, index):
+        return self.children(index, 1)[0]
+
+    def derive(self, path):
+        '''Returns the node at path (like "m/0/1") below this one.
+        Every node along the way is kept in this node's node_cache, so
+        paths that share a parent only derive it once.'''
+        node = self
+        indices = parse_path(path)
+        for i, index in enumerate(indices):
+            key = tuple(indices[:i + 1])
+            cached = self.node_cache.get(key)
+            if cached is None:
+                cached = node.child(index)
+                self.node_cache.put(key, cached)
+            node = cached
+        return node
+
+    def derive_range(self, path, start, count, executor=None, chunk_size=DERIVE_CHUNK_SIZE):
+        '''Returns the children start to start+count-1 of the node at path.
+        With an executor (such as a ProcessPoolExecutor) chunks of children
+        are derived in parallel; the order of the result is the same.'''
+        parent = self.derive(path)
+        if executor is None:
+            return parent.children(start, count)
+        futures = []
+        for chunk_start in range(start, start + count, chunk_size):
+            size = min(chunk_size, start + count - chunk_start)
+            futures.append(executor.submit(parent.children, chunk_start, size))
+        result = []
+        for future in futures:
+            result.extend(future.result())
+        return result
+
+
+class HDPrivateKey(HDPublicKey):
+
+    def __init__(self, private_key, chain_code, depth=0, parent_fingerprint=b'\x00' * 4,
+                 child_number=0, testnet=False):
+        super().__init__(private_key.point, chain_code, depth, parent_fingerprint,
+                         child_number, testnet)
+        self.private_key = private_key
+
+    @classmethod
+    def from_seed(cls, seed, testnet=False):
+        '''Returns the master key for a seed (bytes)'''
+        h = hmac.new(b'Bitcoin seed', seed, hashlib.sha512).digest()
+        secret = int.from_bytes(h[:32], 'big')
+        if not 0 < secret < N:
+            raise ValueError('invalid master key, use another seed')
+        return cls(PrivateKey(secret), h[32:], testnet=testnet)
+
+    def key_bytes(self):
+        return b'\x00' + self.private_key.secret.to_bytes(32, 'big')
+
+    def version(self):
+        return XPRV[self.testnet]
+
+    def public(self):
+        '''Returns the HDPublicKey for this node (the xpub)'''
+        return HDPublicKey(self.point, self.chain_code, self.depth,
+                           self.parent_fingerprint, self.child_number, self.testnet)
+
+    def children(self, start, count):
+        '''Returns the children start to start+count-1, hardened ones
+        included. All the child public keys share one inversion.'''
+        sec = self.point.sec()
+        fingerprint = hash160(sec)[:4]
+        secret = self.private_key.secret
+        hardened_data = self.key_bytes()
+        secrets = []
+        chain_codes = []
+        for index in range(start, start + count):
+            data = hardened_data if index >= HARDENED else sec
+            il, chain_code = self.tweak(data, index)
+            child_secret = (il + secret) % N
+            if child_secret == 0:
+                raise ValueError('invalid child {}, use the next index'.format(index))
+            secrets.append(child_secret)
+            chain_codes.append(chain_code)
+        points = jacobian_batch_to_affine([GeneratorTable.multiply(s) for s in secrets])
+        result = []
+        for index, child_secret, chain_code, affine in zip(range(start, start + count), secrets, chain_codes, points):
+            # the point is already known, so skip PrivateKey's multiplication
+            private_key = PrivateKey.__new__(PrivateKey)
+            private_key.secret = child_secret
+            private_key.point = S256Point._unchecked(*affine)
+            result.append(HDPrivateKey(private_key, chain_code, self.depth + 1, fingerprint, index, self.testnet))
+        return result
+
+
+class HDTest(TestCase):
+
+    # BIP32 test vector 1
+    seed = bytes.fromhex('000102030405060708090a0b0c0d0e0f')
+    vectors = (
+        ('m',
+         'xpub661MyMwAqRbcFtXgS5sYJABqqG9YLmC4Q1Rdap9gSE8NqtwybGhePY2gZ29ESFjqJoCu1Rupje8YtGqsefD265TMg7usUDFdp6W1EGMcet8',
+         'xprv9s21ZrQH143K3QTDL4LXw2F7HEK3wJUD2nW2nRk4stbPy6cq3jPPqjiChkVvvNKmPGJxWUtg6LnF5kejMRNNU3TGtRBeJgk33yuGBxrMPHi'),
+        ("m/0'",
+         'xpub68Gmy5EdvgibQVfPdqkBBCHxA5htiqg55crXYuXoQRKfDBFA1WEjWgP6LHhwBZeNK1VTsfTFUHCdrfp1bgwQ9xv5ski8PX9rL2dZXvgGDnw',
+         'xprv9uHRZZhk6KAJC1avXpDAp4MDc3sQKNxDiPvvkX8Br5ngLNv1TxvUxt4cV1rGL5hj6KCesnDYUhd7oWgT11eZG7XnxHrnYeSvkzY7d2bhkJ7'),
+        ("m/0'/1",
+         'xpub6ASuArnXKPbfEwhqN6e3mwBcDTgzisQN1wXN9BJcM47sSikHjJf3UFHKkNAWbWMiGj7Wf5uMash7SyYq527Hqck2AxYysAA7xmALppuCkwQ',
+         'xprv9wTYmMFdV23N2TdNG573QoEsfRrWKQgWeibmLntzniatZvR9BmLnvSxqu53Kw1UmYPxLgboyZQaXwTCg8MSY3H2EU4pWcQDnRnrVA1xe8fs'),
+        ("m/0'/1/2h",
+         'xpub6D4BDPcP2GT577Vvch3R8wDkScZWzQzMMUm3PWbmWvVJrZwQY4VUNgqFJPMM3No2dFDFGTsxxpG5uJh7n7epu4trkrX7x7DogT5Uv6fcLW5',
+         'xprv9z4pot5VBttmtdRTWfWQmoH1taj2axGVzFqSb8C9xaxKymcFzXBDptWmT7FwuEzG3ryjH4ktypQSAewRiNMjANTtpgP4mLTj34bhnZX7UiM'),
+    )
+
+    def test_derive(self):
+        master = HDPrivateKey.from_seed(self.seed)
+        for path, xpub, xprv in self.vectors:
+            node = master.derive(path)
+            self.assertEqual(node.serialize(), xprv)
+            self.assertEqual(node.public().serialize(), xpub)
+
+    def test_parse(self):
+        for _, xpub, xprv in self.vectors:
+            self.assertEqual(HDPublicKey.parse(xpub).serialize(), xpub)
+            self.assertEqual(HDPublicKey.parse(xprv).serialize(), xprv)
+        self.assertIsInstance(HDPublicKey.parse(xprv), HDPrivateKey)
+        self.assertNotIsInstance(HDPublicKey.parse(xpub), HDPrivateKey)
+        with self.assertRaises(ValueError):
+            HDPublicKey.parse(encode_base58_checksum(b'\x00' * 78))
+
+    def test_public_derivation(self):
+        # a watch-only xpub gives the same children as the xprv
+        xprv = HDPrivateKey.parse(self.vectors[2][2])
+        xpub = HDPublicKey.parse(self.vectors[2][1])
+        want = [node.public() for node in xprv.derive_range('m/2', 0, 5)]
+        self.assertEqual(xpub.derive_range('m/2', 0, 5), want)
+        self.assertEqual(xpub.derive('m/2/3').address(), xprv.derive('m/2/3').address())
+        with self.assertRaises(ValueError):
+            xpub.derive("m/0'")
+
+    def test_node_cache(self):
+        master = HDPrivateKey.from_seed(self.seed, testnet=True)
+        account = master.derive("m/44'/1'/0'")
+        self.assertEqual(master.node_cache.misses, 3)
+        self.assertIs(master.derive("m/44'/1'/0'"), account)
+        # only the last step of a longer path is new
+        change = master.derive("m/44'/1'/0'/1")
+        self.assertEqual(change.parent_fingerprint, account.fingerprint())
+        self.assertEqual(master.node_cache.misses, 4)
+        self.assertEqual(len(account.node_cache), 0)
+        # the cache belongs to the node, so other wallets start empty
+        other = HDPrivateKey.from_seed(self.seed[::-1], testnet=True)
+        self.assertEqual(len(other.node_cache), 0)
+        self.assertIsNot(other.derive("m/44'/1'/0'"), account)
+        self.assertEqual(other.node_cache.misses, 3)
+        public = master.public()
+        self.assertEqual(public.derive('m/1').serialize(), master.derive('m/1').public().serialize())
+        self.assertEqual(public.node_cache.misses, 1)
+
+    def test_node_cache_network(self):
+        path, _, xprv = self.vectors[1]
+        mainnet = HDPrivateKey.from_seed(self.seed).derive(path)
+        testnet = HDPrivateKey.from_seed(self.seed, testnet=True).derive(path)
+        self.assertEqual(mainnet.serialize(), xprv)
+        self.assertFalse(mainnet.testnet)
+        self.assertTrue(testnet.testnet)
+        self.assertTrue(testnet.serialize().startswith('tprv'))
+        self.assertTrue(testnet.public().serialize().startswith('tpub'))
+        # the same key and chain code, with testnet versions
+        self.assertEqual(decode_base58_checksum(testnet.serialize())[4:], decode_base58_checksum(xprv)[4:])
+
+    def test_derive_range(self):
+        master = HDPrivateKey.from_seed(self.seed)
+        want = [master.derive('m/0/{}'.format(i)) for i in range(10, 17)]
+        self.assertEqual(master.derive_range('m/0', 10, 7), want)
+        self.assertEqual([node.private_key.point for node in want],
+                         [PrivateKey(node.private_key.secret).point for node in want])
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(master.derive_range('m/0', 10, 7, executor, chunk_size=3), want)
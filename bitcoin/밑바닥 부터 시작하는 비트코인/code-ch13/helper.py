@@ -1,12 +1,17 @@
+from collections import OrderedDict
 from unittest import TestCase, TestSuite, TextTestRunner
 
 import hashlib
 
+import base58
+import ripemd160
+
+from base58 import BASE58_ALPHABET  # noqa: F401
+
 
 SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
-BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 TWO_WEEKS = 60 * 60 * 24 * 14
 MAX_TARGET = 0xffff * 256**(0x1d - 3)
 
@@ -19,7 +24,12 @@ def run(test):
 
 def hash160(s):
     '''sha256 followed by ripemd160'''
-    return hashlib.new('ripemd160', hashlib.sha256(s).digest()).digest()
+    return ripemd160.digest(hashlib.sha256(s).digest())
+
+
+def hash160_many(items):
+    '''hash160 of every item in items'''
+    return ripemd160.hash160_many(items)
 
 
 def hash256(s):
@@ -31,38 +41,29 @@ def sha256(s):
     return hashlib.sha256(s).digest()
 
 
+def tagged_hash(tag, msg):
+    '''BIP340 tagged hash: sha256(sha256(tag) + sha256(tag) + msg)'''
+    tag_hash = hashlib.sha256(tag.encode('ascii')).digest()
+    return hashlib.sha256(tag_hash + tag_hash + msg).digest()
+
+
 def encode_base58(s):
-    # determine how many 0 bytes (b'\x00') s starts with
-    count = 0
-    for c in s:
-        if c == 0:
-            count += 1
-        else:
-            break
-    # convert to big endian integer
-    num = int.from_bytes(s, 'big')
-    prefix = '1' * count
-    result = ''
-    while num > 0:
-        num, mod = divmod(num, 58)
-        result = BASE58_ALPHABET[mod] + result
-    return prefix + result
+    return base58.encode(s)
 
 
 def encode_base58_checksum(s):
-    return encode_base58(s + hash256(s)[:4])
+    return base58.encode_check(s)
 
 
 def decode_base58(s):
-    num = 0
-    for c in s:
-        num *= 58
-        num += BASE58_ALPHABET.index(c)
-    combined = num.to_bytes(25, byteorder='big')
-    checksum = combined[-4:]
-    if hash256(combined[:-4])[:4] != checksum:
-        raise ValueError('bad address: {} {}'.format(checksum, hash256(combined[:-4])[:4]))
-    return combined[1:-4]
+    '''Returns the hash160 in a P2PKH or P2SH address'''
+    return base58.decode_check(s)[1:]
+
+
+def decode_base58_checksum(s):
+    '''Decodes a base58check string of any length, such as an extended
+    key, and returns the payload without the checksum'''
+    return base58.decode_check(s)
 
 
 def little_endian_to_int(b):
@@ -285,8 +286,67 @@ def murmur3(data, seed=0):
     return h1 & 0xffffffff
 
 
+class LRUCache:
+    '''Mapping that keeps at most maxsize entries, dropping the least
+    recently used one when full. hits and misses count get() results
+    so the size can be tuned.'''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            # the first entry is the least recently used
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
 class HelperTest(TestCase):
 
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.put(b'a', 1)
+        cache.put(b'b', 2)
+        self.assertEqual(cache.get(b'a'), 1)
+        # b is now the least recently used
+        cache.put(b'c', 3)
+        self.assertNotIn(b'b', cache)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'c'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        cache.clear()
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+
+    def test_hash160_many(self):
+        items = [b'', b'hello', bytes(100)]
+        self.assertEqual(hash160_many(items), [hash160(s) for s in items])
+
     def test_little_endian_to_int(self):
         h = bytes.fromhex('99c3980000000000')
         want = 10011545
@@ -310,6 +370,11 @@ class HelperTest(TestCase):
         self.assertEqual(h160, want)
         got = encode_base58_checksum(b'\x6f' + bytes.fromhex(h160))
         self.assertEqual(got, addr)
+        self.assertEqual(decode_base58_checksum(addr), b'\x6f' + bytes.fromhex(h160))
+        # leading zero bytes come back
+        self.assertEqual(decode_base58_checksum(encode_base58_checksum(b'\x00\x00\x01')), b'\x00\x00\x01')
+        with self.assertRaises(ValueError):
+            decode_base58_checksum(addr[:-1] + 'Y')
 
     def test_p2pkh_address(self):
         h160 = bytes.fromhex('74d691da1574e6b3c192ecfb52cc8984ee7b6c56')
@@ -1,14 +1,28 @@
 import math
 
 from io import BytesIO
+from random import randint, random
 from unittest import TestCase
 
+from block import Block
+from bloomfilter import (
+    BLOOM_UPDATE_ALL,
+    BLOOM_UPDATE_NONE,
+    BloomFilter,
+    tx_elements,
+)
 from helper import (
+    bit_field_to_bytes,
     bytes_to_bit_field,
+    encode_varint,
+    int_to_little_endian,
     little_endian_to_int,
     merkle_parent,
+    merkle_root,
     read_varint,
 )
+from script import p2pkh_script, Script
+from tx import Tx, TxIn, TxOut
 
 
 class MerkleTree:
@@ -133,6 +147,72 @@ class MerkleTree:
                 raise RuntimeError('flag bits not all consumed')
 
 
+class FlatMerkleTree:
+    '''The same tree as MerkleTree in one flat list. Node index at depth
+    is nodes[offsets[depth] + index]. populate_tree reads the flag bits
+    and hashes with iterators, so a proof is verified in linear time.'''
+
+    def __init__(self, total):
+        self.total = total
+        # the number of levels below the root, without floating point log
+        self.max_depth = (total - 1).bit_length()
+        # level sizes from the leaves up, then offsets from the root down
+        sizes = [total]
+        for _ in range(self.max_depth):
+            sizes.append((sizes[-1] + 1) // 2)
+        self.sizes = sizes[::-1]
+        self.offsets = []
+        offset = 0
+        for size in self.sizes:
+            self.offsets.append(offset)
+            offset += size
+        self.nodes = [None] * offset
+
+    def root(self):
+        return self.nodes[0]
+
+    def get_node(self, depth, index):
+        return self.nodes[self.offsets[depth] + index]
+
+    def levels(self):
+        '''The nodes as a list per depth, like MerkleTree.nodes'''
+        return [self.nodes[offset:offset + size] for offset, size in zip(self.offsets, self.sizes)]
+
+    def populate_tree(self, flag_bits, hashes):
+        flag_bits = iter(flag_bits)
+        hashes = iter(hashes)
+        nodes = self.nodes
+        offsets = self.offsets
+        sizes = self.sizes
+        max_depth = self.max_depth
+
+        def visit(depth, index):
+            # a leaf or a sub-tree with nothing matched is a given hash,
+            # anything else is the parent of its children
+            if next(flag_bits) == 0 or depth == max_depth:
+                h = next(hashes)
+            else:
+                left = visit(depth + 1, index * 2)
+                if index * 2 + 1 < sizes[depth + 1]:
+                    right = visit(depth + 1, index * 2 + 1)
+                else:
+                    right = left
+                h = merkle_parent(left, right)
+            nodes[offsets[depth] + index] = h
+            return h
+
+        try:
+            visit(0, 0)
+        except StopIteration:
+            raise RuntimeError('ran out of flag bits or hashes')
+        remaining = sum(1 for _ in hashes)
+        if remaining != 0:
+            raise RuntimeError('hashes not all consumed {}'.format(remaining))
+        for flag_bit in flag_bits:
+            if flag_bit != 0:
+                raise RuntimeError('flag bits not all consumed')
+
+
 class MerkleTreeTest(TestCase):
 
     def test_init(self):
@@ -183,6 +263,91 @@ class MerkleTreeTest(TestCase):
         self.assertEqual(tree.root().hex(), root)
 
 
+def merkle_levels(hashes):
+    '''Returns every level of the merkle tree of hashes, leaves first and
+    the root last. An odd last hash is paired with itself.'''
+    levels = [list(hashes)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = []
+        for i in range(0, len(level), 2):
+            right = level[i + 1] if i + 1 < len(level) else level[i]
+            parents.append(merkle_parent(level[i], right))
+        levels.append(parents)
+    return levels
+
+
+def partial_merkle_tree(levels, matches):
+    '''Returns the (hashes, flag bits) of a BIP0037 partial merkle tree
+    that proves the leaves where matches is True. Only the matched
+    paths and their siblings are visited, so it's O(n) in the worst case.'''
+    # matched[h][i] is whether any leaf under node i at height h matched
+    matched = [list(matches)]
+    while len(matched) < len(levels):
+        below = matched[-1]
+        matched.append([any(below[i:i + 2]) for i in range(0, len(below), 2)])
+    hashes = []
+    flag_bits = []
+    # depth-first, left before right, like populate_tree reads them
+    stack = [(len(levels) - 1, 0)]
+    while stack:
+        height, index = stack.pop()
+        flag = matched[height][index]
+        flag_bits.append(1 if flag else 0)
+        if height == 0 or not flag:
+            hashes.append(levels[height][index])
+            continue
+        left = index * 2
+        if left + 1 < len(levels[height - 1]):
+            stack.append((height - 1, left + 1))
+        stack.append((height - 1, left))
+    return hashes, flag_bits
+
+
+class FlatMerkleTreeTest(TestCase):
+
+    def test_init(self):
+        tree = FlatMerkleTree(9)
+        self.assertEqual(tree.sizes, [1, 2, 3, 5, 9])
+        self.assertEqual(tree.offsets, [0, 1, 3, 6, 11])
+        self.assertEqual(len(tree.nodes), 20)
+        self.assertEqual(FlatMerkleTree(1).sizes, [1])
+
+    def test_populate_tree(self):
+        hashes = [bytes.fromhex(h) for h in (
+            '42f6f52f17620653dcc909e58bb352e0bd4bd1381e2955d19c00959a22122b2e',
+            '94c3af34b9667bf787e1c6a0a009201589755d01d02fe2877cc69b929d2418d4',
+            '959428d7c48113cb9149d0566bde3d46e98cf028053c522b8fa8f735241aa953',
+            'a9f27b99d5d108dede755710d4a1ffa2c74af70b4ca71726fa57d68454e609a2',
+            '62af110031e29de1efcad103b3ad4bec7bdcf6cb9c9f4afdd586981795516577',
+        )]
+        tree = FlatMerkleTree(len(hashes))
+        tree.populate_tree([1] * 11, hashes)
+        root = 'a8e8bd023169b81bc56854137a135b97ef47a6a7237f4c6e037baed16285a5ab'
+        self.assertEqual(tree.root().hex(), root)
+        with self.assertRaises(RuntimeError):
+            FlatMerkleTree(len(hashes)).populate_tree([1] * 11, hashes + hashes[:1])
+        with self.assertRaises(RuntimeError):
+            FlatMerkleTree(len(hashes)).populate_tree([1] * 11, hashes[:4])
+
+    def test_stress(self):
+        # blocks up to the largest legacy block size, about 4000 transactions,
+        # with proofs from partial_merkle_tree checked against MerkleTree
+        for total in (1, 2, 3, 255, 256, 257, 1025, 4000, 4096):
+            leaves = [randint(0, 2**256 - 1).to_bytes(32, 'big') for _ in range(total)]
+            levels = merkle_levels(leaves)
+            for rate in (0, 0.001, 0.05, 1):
+                matches = [random() < rate for _ in range(total)]
+                hashes, flag_bits = partial_merkle_tree(levels, matches)
+                flag_bits += [0] * (-len(flag_bits) % 8)
+                tree = FlatMerkleTree(total)
+                tree.populate_tree(flag_bits, hashes)
+                self.assertEqual(tree.root(), levels[-1][0])
+                want = MerkleTree(total)
+                want.populate_tree(list(flag_bits), list(hashes))
+                self.assertEqual(tree.levels(), want.nodes)
+
+
 class MerkleBlock:
     command = b'merkleblock'
 
@@ -234,6 +399,22 @@ class MerkleBlock:
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce,
                    total, hashes, flags)
 
+    def serialize(self):
+        '''Returns the merkleblock message payload'''
+        result = int_to_little_endian(self.version, 4)
+        result += self.prev_block[::-1]
+        result += self.merkle_root[::-1]
+        result += int_to_little_endian(self.timestamp, 4)
+        result += self.bits
+        result += self.nonce
+        result += int_to_little_endian(self.total, 4)
+        result += encode_varint(len(self.hashes))
+        for h in self.hashes:
+            result += h[::-1]
+        result += encode_varint(len(self.flags))
+        result += self.flags
+        return result
+
     def is_valid(self):
         '''Verifies whether the merkle tree information validates to the merkle root'''
         # convert the flags field to a bit field
@@ -241,13 +422,44 @@ class MerkleBlock:
         # reverse self.hashes for the merkle root calculation
         hashes = [h[::-1] for h in self.hashes]
         # initialize the merkle tree
-        merkle_tree = MerkleTree(self.total)
+        merkle_tree = FlatMerkleTree(self.total)
         # populate the tree with flag bits and hashes
         merkle_tree.populate_tree(flag_bits, hashes)
         # check if the computed root reversed is the same as the merkle root
         return merkle_tree.root()[::-1] == self.merkle_root
 
 
+class MerkleBlockBuilder:
+    '''Answers BIP0037 filtered block requests for one full block.
+    The merkle tree and the parts of every transaction that filters look
+    at are computed once, so each client only costs the filter matching
+    and one walk down the matched paths.'''
+
+    def __init__(self, block, txs):
+        self.block = block
+        self.txs = txs
+        self.elements = [tx_elements(tx) for tx in txs]
+        # hash256 byte order, like the hashes in populate_tree
+        self.levels = merkle_levels([txid for txid, _, _ in self.elements])
+        if self.levels[-1][0][::-1] != block.merkle_root:
+            raise ValueError('transactions do not match the merkle root')
+
+    def merkle_block(self, bloom_filter, flag=BLOOM_UPDATE_NONE):
+        '''Returns the MerkleBlock for a client's filter and the matched
+        transactions, which are sent after it. The filter is updated
+        according to flag, like a node does with the filterload flag.'''
+        matches = bloom_filter.match_elements(self.elements, flag)
+        hashes, flag_bits = partial_merkle_tree(self.levels, matches)
+        # pad the flags to whole bytes
+        flag_bits += [0] * (-len(flag_bits) % 8)
+        block = self.block
+        merkle_block = MerkleBlock(
+            block.version, block.prev_block, block.merkle_root, block.timestamp,
+            block.bits, block.nonce, len(self.txs), [h[::-1] for h in hashes],
+            bit_field_to_bytes(flag_bits))
+        return merkle_block, [tx for tx, match in zip(self.txs, matches) if match]
+
+
 class MerkleBlockTest(TestCase):
 
     def test_parse(self):
@@ -290,3 +502,69 @@ class MerkleBlockTest(TestCase):
         hex_merkle_block = '00000020df3b053dc46f162a9b00c7f0d5124e2676d47bbe7c5d0793a500000000000000ef445fef2ed495c275892206ca533e7411907971013ab83e3b47bd0d692d14d4dc7c835b67d8001ac157e670bf0d00000aba412a0d1480e370173072c9562becffe87aa661c1e4a6dbc305d38ec5dc088a7cf92e6458aca7b32edae818f9c2c98c37e06bf72ae0ce80649a38655ee1e27d34d9421d940b16732f24b94023e9d572a7f9ab8023434a4feb532d2adfc8c2c2158785d1bd04eb99df2e86c54bc13e139862897217400def5d72c280222c4cbaee7261831e1550dbb8fa82853e9fe506fc5fda3f7b919d8fe74b6282f92763cef8e625f977af7c8619c32a369b832bc2d051ecd9c73c51e76370ceabd4f25097c256597fa898d404ed53425de608ac6bfe426f6e2bb457f1c554866eb69dcb8d6bf6f880e9a59b3cd053e6c7060eeacaacf4dac6697dac20e4bd3f38a2ea2543d1ab7953e3430790a9f81e1c67f5b58c825acf46bd02848384eebe9af917274cdfbb1a28a5d58a23a17977def0de10d644258d9c54f886d47d293a411cb6226103b55635'
         mb = MerkleBlock.parse(BytesIO(bytes.fromhex(hex_merkle_block)))
         self.assertTrue(mb.is_valid())
+
+
+class MerkleBlockBuilderTest(TestCase):
+
+    @staticmethod
+    def make_block(count):
+        # transactions paying to h160s 0, 1, 2 ..., each spending the
+        # previous one's first output
+        txs = []
+        prev_tx = b'\x11' * 32
+        for i in range(count):
+            tx_in = TxIn(prev_tx, 0, Script([b'sig' + bytes([i % 256])]))
+            tx_outs = [TxOut(1000, p2pkh_script(i.to_bytes(20, 'big'))),
+                       TxOut(2000, p2pkh_script(b'\xff' * 20))]
+            tx = Tx(1, [tx_in], tx_outs, i)
+            txs.append(tx)
+            prev_tx = tx.hash()
+        root = merkle_root([tx.hash()[::-1] for tx in txs])[::-1]
+        block = Block(0x20000000, b'\x00' * 32, root, 1500000000, bytes.fromhex('ffff001d'), b'\x00' * 4)
+        return block, txs
+
+    def round_trip(self, merkle_block):
+        parsed = MerkleBlock.parse(BytesIO(merkle_block.serialize()))
+        self.assertEqual(parsed.serialize(), merkle_block.serialize())
+        self.assertTrue(parsed.is_valid())
+        return parsed
+
+    def test_merkle_block(self):
+        for count in (1, 2, 7, 100):
+            block, txs = self.make_block(count)
+            builder = MerkleBlockBuilder(block, txs)
+            bf = BloomFilter(1000, 5, 90210)
+            bf.add((count // 2).to_bytes(20, 'big'))
+            merkle_block, matched = builder.merkle_block(bf)
+            self.assertEqual(matched, [txs[count // 2]])
+            parsed = self.round_trip(merkle_block)
+            self.assertIn(txs[count // 2].hash(), parsed.hashes)
+            # nothing matched is just the root
+            merkle_block, matched = builder.merkle_block(BloomFilter(1000, 5, 1))
+            self.assertEqual((matched, merkle_block.hashes), ([], [block.merkle_root]))
+            self.round_trip(merkle_block)
+            # everything matched sends every txid
+            bf = BloomFilter(1000, 5, 1)
+            bf.add(b'\xff' * 20)
+            merkle_block, matched = builder.merkle_block(bf)
+            self.assertEqual(matched, txs)
+            self.assertEqual(self.round_trip(merkle_block).hashes, [tx.hash() for tx in txs])
+
+    def test_update(self):
+        block, txs = self.make_block(20)
+        builder = MerkleBlockBuilder(block, txs)
+        bf = BloomFilter(1000, 5, 90210)
+        bf.add((5).to_bytes(20, 'big'))
+        # without updates only the payment matches
+        _, matched = builder.merkle_block(bf, BLOOM_UPDATE_NONE)
+        self.assertEqual(matched, [txs[5]])
+        # with updates the outpoint goes in the filter, and so
+        # the next transaction, which spends it, matches too
+        _, matched = builder.merkle_block(bf, BLOOM_UPDATE_ALL)
+        self.assertEqual(matched, [txs[5], txs[6]])
+        self.assertTrue(bf.contains(txs[5].hash()[::-1] + b'\x00' * 4))
+
+    def test_bad_root(self):
+        block, txs = self.make_block(3)
+        with self.assertRaises(ValueError):
+            MerkleBlockBuilder(block, txs[:2])
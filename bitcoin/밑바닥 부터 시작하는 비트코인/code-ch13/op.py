@@ -1,4 +1,5 @@
 import hashlib
+import ripemd160
 
 from logging import getLogger
 from unittest import TestCase
@@ -6,6 +7,7 @@ from unittest import TestCase
 from ecc import (
     S256Point,
     Signature,
+    verify_batch,
 )
 
 from helper import (
@@ -619,7 +621,7 @@ def op_ripemd160(stack):
     if len(stack) < 1:
         return False
     element = stack.pop()
-    stack.append(hashlib.new('ripemd160', element).digest())
+    stack.append(ripemd160.digest(element))
     return True
 
 
@@ -659,7 +661,7 @@ def op_hash256(stack):
     return True
 
 
-def op_checksig(stack, z):
+def op_checksig(stack, z, batch=None):
     # check that there are at least 2 elements on the stack
     if len(stack) < 2:
         return False
@@ -675,6 +677,14 @@ def op_checksig(stack, z):
     except (ValueError, SyntaxError) as e:
         LOGGER.info(e)
         return False
+    if batch is not None:
+        # collect the signature for verify_batch and assume it's valid
+        # Script.evaluate only passes a batch when a bad signature would
+        # fail the script anyway, so the result stays the same
+        # the SEC and DER bytes go along for verify_parallel's workers
+        batch.append((point, z, sig, sec_pubkey, der_signature))
+        stack.append(encode_num(1))
+        return True
     # verify the signature using S256Point.verify()
     # push an encoded 1 or 0 depending on whether the signature verified
     if point.verify(z, sig):
@@ -684,8 +694,8 @@ def op_checksig(stack, z):
     return True
 
 
-def op_checksigverify(stack, z):
-    return op_checksig(stack, z) and op_verify(stack)
+def op_checksigverify(stack, z, batch=None):
+    return op_checksig(stack, z, batch) and op_verify(stack)
 
 
 def op_checkmultisig(stack, z):
@@ -786,6 +796,13 @@ class OpTest(TestCase):
         stack = [sig, sec]
         self.assertTrue(op_checksig(stack, z))
         self.assertEqual(decode_num(stack[0]), 1)
+        # in batch mode the check is collected instead
+        stack = [sig, sec]
+        batch = []
+        self.assertTrue(op_checksig(stack, z, batch))
+        self.assertEqual(decode_num(stack[0]), 1)
+        self.assertEqual(len(batch), 1)
+        self.assertTrue(verify_batch(batch))
 
     def test_op_checkmultisig(self):
         z = 0xe71bfa115715d6fd33796948126f40a8cdd39f187e4afb03896795189fe1423c
@@ -0,0 +1,194 @@
+'''RIPEMD-160 with a pure-Python fallback.
+
+hashlib only has ripemd160 when OpenSSL provides it, and OpenSSL 3 moved it
+to the legacy provider, which often isn't loaded. BACKEND says which
+implementation digest uses: 'hashlib' if it works here, otherwise 'python'.
+Set RIPEMD160_BACKEND=python in the environment to force the fallback.
+'''
+from unittest import TestCase
+
+import hashlib
+import os
+import struct
+
+
+MASK = 0xffffffff
+INITIAL_STATE = (0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0)
+
+# message word and rotation for each of the 80 steps of both lines
+LEFT_WORDS = (
+    0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15,
+    7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+    3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12,
+    1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+    4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13)
+RIGHT_WORDS = (
+    5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12,
+    6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+    15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13,
+    8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+    12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11)
+LEFT_SHIFTS = (
+    11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8,
+    7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+    11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5,
+    11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+    9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6)
+RIGHT_SHIFTS = (
+    8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6,
+    9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+    9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5,
+    15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+    8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11)
+LEFT_CONSTANTS = (0x00000000, 0x5a827999, 0x6ed9eba1, 0x8f1bbcdc, 0xa953fd4e)
+RIGHT_CONSTANTS = (0x50a28be6, 0x5c4dd124, 0x6d703ef3, 0x7a6d76e9, 0x00000000)
+
+
+def _round_steps(words, shifts):
+    '''Splits the 80 steps into 5 rounds of 16 (word, shift, 32 - shift)'''
+    steps = tuple(zip(words, shifts, [32 - s for s in shifts]))
+    return tuple(steps[i:i + 16] for i in range(0, 80, 16))
+
+
+L1, L2, L3, L4, L5 = _round_steps(LEFT_WORDS, LEFT_SHIFTS)
+R1, R2, R3, R4, R5 = _round_steps(RIGHT_WORDS, RIGHT_SHIFTS)
+KL1, KL2, KL3, KL4, KL5 = LEFT_CONSTANTS
+KR1, KR2, KR3, KR4, KR5 = RIGHT_CONSTANTS
+# what python_digest appends to a 32 byte message
+SHA256_PADDING = b'\x80' + b'\x00' * 23 + struct.pack('<Q', 256)
+
+
+def compress(state, block):
+    '''Returns the state after one 64 byte block.
+    Each round has its own loop so its boolean function and constant are
+    written inline instead of being picked per step.'''
+    x = struct.unpack('<16L', block)
+    h0, h1, h2, h3, h4 = state
+    a, b, c, d, e = state
+    for i, s, t in L1:
+        v = (a + (b ^ c ^ d) + x[i]) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    for i, s, t in L2:
+        v = (a + ((b & c) | (~b & d)) + x[i] + KL2) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    for i, s, t in L3:
+        v = (a + ((b | (c ^ MASK)) ^ d) + x[i] + KL3) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    for i, s, t in L4:
+        v = (a + ((b & d) | (c & ~d)) + x[i] + KL4) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    for i, s, t in L5:
+        v = (a + (b ^ (c | (d ^ MASK))) + x[i] + KL5) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    left = a, b, c, d, e
+    # the right line uses the boolean functions in reverse order
+    a, b, c, d, e = state
+    for i, s, t in R1:
+        v = (a + (b ^ (c | (d ^ MASK))) + x[i] + KR1) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    for i, s, t in R2:
+        v = (a + ((b & d) | (c & ~d)) + x[i] + KR2) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    for i, s, t in R3:
+        v = (a + ((b | (c ^ MASK)) ^ d) + x[i] + KR3) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    for i, s, t in R4:
+        v = (a + ((b & c) | (~b & d)) + x[i] + KR4) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    for i, s, t in R5:
+        v = (a + (b ^ c ^ d) + x[i]) & MASK
+        a, b, c, d, e = e, (((v << s) | (v >> t)) + e) & MASK, b, ((c << 10) | (c >> 22)) & MASK, d
+    al, bl, cl, dl, el = left
+    return (
+        (h1 + cl + d) & MASK,
+        (h2 + dl + e) & MASK,
+        (h3 + el + a) & MASK,
+        (h4 + al + b) & MASK,
+        (h0 + bl + c) & MASK,
+    )
+
+
+def python_digest(data):
+    '''RIPEMD-160 of data in pure Python'''
+    length = len(data)
+    # pad to 56 mod 64 with 0x80 and zeros, then the bit length (little endian)
+    data = bytes(data) + b'\x80' + b'\x00' * ((55 - length) % 64) + struct.pack('<Q', 8 * length)
+    state = INITIAL_STATE
+    for i in range(0, len(data), 64):
+        state = compress(state, data[i:i + 64])
+    return struct.pack('<5L', *state)
+
+
+def _hashlib_available():
+    try:
+        hashlib.new('ripemd160', b'')
+    except ValueError:
+        return False
+    return True
+
+
+if os.environ.get('RIPEMD160_BACKEND') != 'python' and _hashlib_available():
+    BACKEND = 'hashlib'
+    # copying a prepared object skips the lookup by name in hashlib.new
+    _EMPTY = hashlib.new('ripemd160')
+
+    def digest(data):
+        h = _EMPTY.copy()
+        h.update(data)
+        return h.digest()
+else:
+    BACKEND = 'python'
+    digest = python_digest
+
+
+def hash160_many(items):
+    '''Returns [ripemd160(sha256(s)) for s in items], with the backend
+    looked up once for the whole batch'''
+    sha256 = hashlib.sha256
+    if BACKEND == 'hashlib':
+        empty = _EMPTY
+        result = []
+        for s in items:
+            h = empty.copy()
+            h.update(sha256(s).digest())
+            result.append(h.digest())
+        return result
+    # a sha256 digest always pads to the same single block
+    result = []
+    for s in items:
+        state = compress(INITIAL_STATE, sha256(s).digest() + SHA256_PADDING)
+        result.append(struct.pack('<5L', *state))
+    return result
+
+
+class RIPEMD160Test(TestCase):
+
+    def test_python_digest(self):
+        # the test vectors from the RIPEMD-160 paper
+        tests = (
+            (b'', '9c1185a5c5e9fc54612808977ee8f548b2258d31'),
+            (b'a', '0bdc9d2d256b3ee9daae347be6f4dc835a467ffe'),
+            (b'abc', '8eb208f7e05d987a9b044a8e98c6b087f15a0bfc'),
+            (b'message digest', '5d0689ef49d2fae572b881b123a85ffa21595f36'),
+            (b'abcdefghijklmnopqrstuvwxyz', 'f71c27109c692c1b56bbdceb5b9d2865b3708dbc'),
+            (b'abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq', '12a053384a9c0c88e405a06c27dcf49ada62eb2b'),
+            (b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789', 'b0e20b6e3116640286ed3a87a5713079b21f5189'),
+            (b'1234567890' * 8, '9b752e45573d4b39f4dbd3323cab82bf63326bfb'),
+        )
+        for message, want in tests:
+            self.assertEqual(python_digest(message).hex(), want)
+            self.assertEqual(digest(message).hex(), want)
+
+    def test_padding(self):
+        # every length around the block boundaries
+        if not _hashlib_available():
+            return
+        for length in range(130):
+            message = bytes(range(length))
+            self.assertEqual(python_digest(message), hashlib.new('ripemd160', message).digest())
+
+    def test_hash160_many(self):
+        items = [bytes([i]) * i for i in range(50)]
+        want = [python_digest(hashlib.sha256(s).digest()) for s in items]
+        self.assertEqual(hash160_many(items), want)
+        self.assertIn(BACKEND, ('hashlib', 'python'))
@@ -0,0 +1,246 @@
+'''BIP340 Schnorr signatures over secp256k1.
+
+Public keys are x-only: the 32 byte x coordinate of the point with an even y.
+The keys and points are the S256Point and PrivateKey classes from ecc.
+'''
+from random import randint
+from secrets import randbelow
+from unittest import TestCase
+
+from ecc import (
+    G,
+    N,
+    P,
+    B,
+    GeneratorTable,
+    PrivateKey,
+    S256Point,
+    jacobian_to_affine,
+    multi_scalar_mul,
+    precompute_odd_multiples,
+)
+from helper import tagged_hash
+
+
+class SchnorrSignature:
+
+    def __init__(self, r, s):
+        # r is the x coordinate of R, which always has an even y
+        self.r = r
+        self.s = s
+
+    def __repr__(self):
+        return 'SchnorrSignature({:x},{:x})'.format(self.r, self.s)
+
+    def __eq__(self, other):
+        return self.r == other.r and self.s == other.s
+
+    def serialize(self):
+        return self.r.to_bytes(32, 'big') + self.s.to_bytes(32, 'big')
+
+    @classmethod
+    def parse(cls, signature_bin):
+        if len(signature_bin) != 64:
+            raise SyntaxError('Bad Signature Length')
+        r = int.from_bytes(signature_bin[:32], 'big')
+        s = int.from_bytes(signature_bin[32:], 'big')
+        return cls(r, s)
+
+
+def xonly(point):
+    '''Returns the 32 byte x-only public key of point'''
+    return point.jacobian()[0].to_bytes(32, 'big')
+
+
+def lift_x(x):
+    '''Returns the point with x coordinate x and an even y.
+    Raises ValueError if there is none.'''
+    if x >= P:
+        raise ValueError('x {} not in field range'.format(x))
+    y_squared = (x * x * x + B) % P
+    y = pow(y_squared, (P + 1) // 4, P)
+    if y * y % P != y_squared:
+        raise ValueError('{:x} is not the x of a point on the curve'.format(x))
+    if y % 2:
+        y = P - y
+    return S256Point._unchecked(x, y)
+
+
+def parse_xonly(pubkey):
+    '''Returns the point for a 32 byte x-only public key'''
+    if len(pubkey) != 32:
+        raise ValueError('x-only public keys are 32 bytes')
+    # the same as the compressed SEC key with an even y,
+    # so it goes through the parse cache
+    return S256Point.parse(b'\x02' + pubkey)
+
+
+def challenge(r, pubkey, msg):
+    '''e = int(hash_BIP0340/challenge(r || pubkey || msg)) mod N'''
+    e = tagged_hash('BIP0340/challenge', r.to_bytes(32, 'big') + pubkey + msg)
+    return int.from_bytes(e, 'big') % N
+
+
+def sign(private_key, msg, aux_rand=bytes(32)):
+    '''Signs msg (bytes) with private_key, returns a SchnorrSignature.
+    aux_rand is 32 bytes of fresh randomness; all zeros is allowed
+    but gives up the side channel protection it adds.'''
+    x, y, _ = private_key.point.jacobian()
+    # the x-only key stands for the point with an even y
+    d = private_key.secret if y % 2 == 0 else N - private_key.secret
+    pubkey = x.to_bytes(32, 'big')
+    mask = tagged_hash('BIP0340/aux', aux_rand)
+    t = bytes(a ^ b for a, b in zip(d.to_bytes(32, 'big'), mask))
+    k = int.from_bytes(tagged_hash('BIP0340/nonce', t + pubkey + msg), 'big') % N
+    if k == 0:
+        raise ValueError('nonce is zero, try other aux_rand')
+    r, ry = jacobian_to_affine(GeneratorTable.multiply(k))
+    if ry % 2:
+        k = N - k
+    e = challenge(r, pubkey, msg)
+    return SchnorrSignature(r, (k + e * d) % N)
+
+
+def verify(pubkey, msg, sig):
+    '''Returns whether sig is a valid signature of msg for the
+    32 byte x-only pubkey'''
+    if sig.r >= P or sig.s >= N:
+        return False
+    try:
+        point = parse_xonly(pubkey)
+    except ValueError:
+        return False
+    e = challenge(sig.r, pubkey, msg)
+    # R = s*G - e*P
+    total = multi_scalar_mul([(sig.s, G), (N - e, point)])
+    affine = jacobian_to_affine(total)
+    if affine is None:
+        return False
+    x, y = affine
+    return y % 2 == 0 and x == sig.r
+
+
+def verify_batch(items):
+    '''Verifies many (pubkey, msg, SchnorrSignature) triples at once.
+    Every s*G = R + e*P is multiplied by a random a and the sum
+        (a1*s1 + a2*s2 + ...)*G - a1*R1 - a1*e1*P1 - a2*R2 - ...
+    has to be the point at infinity. That's one multi-scalar
+    multiplication with a single doubling chain for the whole batch.
+    A forged signature passes only if it guesses the random factors,
+    so they come from the secrets module.'''
+    terms = []
+    s_total = 0
+    for i, (pubkey, msg, sig) in enumerate(items):
+        if sig.r >= P or sig.s >= N:
+            return False
+        try:
+            point = parse_xonly(pubkey)
+            r_point = lift_x(sig.r)
+        except ValueError:
+            return False
+        e = challenge(sig.r, pubkey, msg)
+        # the first factor can be 1
+        a = 1 if i == 0 else randbelow(N - 1) + 1
+        s_total += a * sig.s
+        terms.append((N - a, r_point))
+        terms.append((N - a * e % N, point))
+    if not terms:
+        return True
+    precompute_odd_multiples([point for _, point in terms])
+    terms.append((s_total, G))
+    return multi_scalar_mul(terms)[2] == 0
+
+
+class SchnorrTest(TestCase):
+
+    # BIP340 test vectors: secret, pubkey, aux_rand, msg, signature, result
+    vectors = (
+        (
+            3,
+            'f9308a019258c31049344f85f89d5229b531c845836f99b08601f113bce036f9',
+            '0000000000000000000000000000000000000000000000000000000000000000',
+            '0000000000000000000000000000000000000000000000000000000000000000',
+            'e907831f80848d1069a5371b402410364bdf1c5f8307b0084c55f1ce2dca821525f66a4a85ea8b71e482a74f382d2ce5ebeee8fdb2172f477df4900d310536c0',
+            True,
+        ),
+        (
+            0xb7e151628aed2a6abf7158809cf4f3c762e7160f38b4da56a784d9045190cfef,
+            'dff1d77f2a671c5f36183726db2341be58feae1da2deced843240f7b502ba659',
+            '0000000000000000000000000000000000000000000000000000000000000001',
+            '243f6a8885a308d313198a2e03707344a4093822299f31d0082efa98ec4e6c89',
+            '6896bd60eeae296db48a229ff71dfe071bde413e6d43f917dc8dcf8c78de33418906d11ac976abccb20b091292bff4ea897efcb639ea871cfa95f6de339e4b0a',
+            True,
+        ),
+        (
+            0xc90fdaa22168c234c4c6628b80dc1cd129024e088a67cc74020bbea63b14e5c9,
+            'dd308afec5777e13121fa72b9cc1b7cc0139715309b086c960e18fd969774eb8',
+            'c87aa53824b4d7ae2eb035a2b5bbbccc080e76cdc6d1692c4b0b62d798e6d906',
+            '7e2d58d8b3bcdf1abadec7829054f90dda9805aab56c77333024b9d0a508b75c',
+            '5831aaeed7b44bb74e5eab94ba9d4294c49bcf2a60728d8b4c200f50dd313c1bab745879a5ad954a72c45a91c3a51d3c7adea98d82f8481e0e1e03674a6f3fb7',
+            True,
+        ),
+        (
+            0x0b432b2677937381aef05bb02a66ecd012773062cf3fa2549e44f58ed2401710,
+            '25d1dff95105f5253c4022f628a996ad3a0d95fbf21d468a1b33f8c160d8f517',
+            'ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff',
+            'ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff',
+            '7eb0509757e246f19449885651611cb965ecc1a187dd51b64fda1edc9637d5ec97582b9cb13db3933705b32ba982af5af25fd78881ebb32771fc5922efc66ea3',
+            True,
+        ),
+        (
+            None,
+            'd69c3509bb99e412e68b0fe8544e72837dfa30746d8be2aa65975f29d22dc7b9',
+            None,
+            '4df3c3f68fcc83b27e9d42c90431a72499f17875c81a599b566c9889b9696703',
+            '00000000000000000000003b78ce563f89a0ed9414f5aa28ad0d96d6795f9c6376afb1548af603b3eb45c9f8207dee1060cb71c04e80f593060b07d28308d7f4',
+            True,
+        ),
+        (
+            # public key not on the curve
+            None,
+            'eefdea4cdb677750a420fee807eacf21eb9898ae79b9768766e4faa04a2d4a34',
+            None,
+            '243f6a8885a308d313198a2e03707344a4093822299f31d0082efa98ec4e6c89',
+            '6cff5c3ba86c69ea4b7376f31a9bcb4f74c1976089b2d9963da2e5543e17776969e89b4c5564d00349106b8497785dd7d1d713a8ae82b32fa79d5f7fc407d39b',
+            False,
+        ),
+    )
+
+    def test_sign(self):
+        for secret, pubkey, aux_rand, msg, sig, _ in self.vectors:
+            if secret is None:
+                continue
+            private_key = PrivateKey(secret)
+            self.assertEqual(xonly(private_key.point).hex(), pubkey)
+            got = sign(private_key, bytes.fromhex(msg), bytes.fromhex(aux_rand))
+            self.assertEqual(got.serialize().hex(), sig)
+
+    def test_verify(self):
+        for _, pubkey, _, msg, sig, result in self.vectors:
+            sig = SchnorrSignature.parse(bytes.fromhex(sig))
+            self.assertEqual(verify(bytes.fromhex(pubkey), bytes.fromhex(msg), sig), result)
+        pubkey = bytes.fromhex(self.vectors[1][1])
+        msg = bytes.fromhex(self.vectors[1][3])
+        sig = SchnorrSignature.parse(bytes.fromhex(self.vectors[1][4]))
+        self.assertFalse(verify(pubkey, msg[::-1], sig))
+        self.assertFalse(verify(pubkey, msg, SchnorrSignature(sig.r, N - sig.s)))
+        self.assertFalse(verify(pubkey, msg, SchnorrSignature(P, sig.s)))
+        self.assertFalse(verify(pubkey, msg, SchnorrSignature(sig.r, N)))
+
+    def test_verify_batch(self):
+        items = []
+        for _, pubkey, _, msg, sig, result in self.vectors:
+            if result:
+                items.append((bytes.fromhex(pubkey), bytes.fromhex(msg), SchnorrSignature.parse(bytes.fromhex(sig))))
+        for _ in range(10):
+            private_key = PrivateKey(randint(1, N - 1))
+            msg = randint(0, 2**256).to_bytes(33, 'big')
+            items.append((xonly(private_key.point), msg, sign(private_key, msg)))
+        self.assertTrue(verify_batch(items))
+        self.assertTrue(verify_batch([]))
+        # one bad signature anywhere fails the batch
+        pubkey, msg, sig = items[7]
+        self.assertFalse(verify_batch(items[:7] + [(pubkey, msg, SchnorrSignature(sig.r, sig.s + 1))] + items[8:]))
+        self.assertFalse(verify_batch(items + [(pubkey, msg + b'\x00', sig)]))
+        bad = self.vectors[5]
+        self.assertFalse(verify_batch(items + [(bytes.fromhex(bad[1]), bytes.fromhex(bad[3]), SchnorrSignature.parse(bytes.fromhex(bad[4])))]))
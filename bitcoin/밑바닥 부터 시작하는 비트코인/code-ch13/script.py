@@ -2,6 +2,7 @@ from io import BytesIO
 from logging import getLogger
 from unittest import TestCase
 
+from ecc import PrivateKey
 from helper import (
     decode_base58,
     encode_varint,
@@ -117,7 +118,7 @@ class Script:
 
     def raw_serialize(self):
         # initialize what we'll send back
-        result = b''
+        result = bytearray()
         # go through each cmd
         for cmd in self.cmds:
             # if the cmd is an integer, it's an opcode
@@ -143,7 +144,7 @@ class Script:
                 else:
                     raise ValueError('too long an cmd')
                 result += cmd
-        return result
+        return bytes(result)
 
     def serialize(self):
         # get the raw serialization (no prepended length)
@@ -153,7 +154,16 @@ class Script:
         # encode_varint the total length of the result and prepend
         return encode_varint(total) + result
 
-    def evaluate(self, z, witness):
+    def write(self, out):
+        '''Appends the serialization to the bytearray out'''
+        result = self.raw_serialize()
+        out += encode_varint(len(result))
+        out += result
+
+    def evaluate(self, z, witness, batch=None):
+        # if batch is a list, a signature check that decides the script
+        # on its own appends its (point, z, sig) there to be verified
+        # later instead of checking it right away
         # create a copy as we may need to add to this list if we have a
         # RedeemScript
         cmds = self.cmds[:]
@@ -174,9 +184,22 @@ class Script:
                     if not operation(stack, altstack):
                         LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
                         return False
-                elif cmd in (172, 173, 174, 175):
+                elif cmd in (172, 173):
                     # these are signing operations, they need a sig_hash
-                    # to check against
+                    # to check against. only a check whose result can't
+                    # change what runs next goes to the batch: the one in
+                    # OP_CHECKSIGVERIFY, or an OP_CHECKSIG with nothing after
+                    # it. a bad signature fails the script either way
+                    if cmd == 173 or len(cmds) == 0:
+                        deferred = batch
+                    else:
+                        deferred = None
+                    if not operation(stack, z, deferred):
+                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
+                        return False
+                elif cmd in (174, 175):
+                    # multisig matches signatures to pubkeys one verify
+                    # at a time, so it always checks right away
                     if not operation(stack, z):
                         LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
                         return False
@@ -319,3 +342,21 @@ class ScriptTest(TestCase):
         self.assertEqual(p2sh_script_pubkey.address(), address_3)
         address_4 = '2N3u1R6uwQfuobCqbCgBkpsgBxvr1tZpe7B'
         self.assertEqual(p2sh_script_pubkey.address(testnet=True), address_4)
+
+    def test_evaluate_batch(self):
+        private_key = PrivateKey(secret=8675309)
+        sec = private_key.point.sec()
+        z = 0xdeadbeef
+        sig = private_key.sign(z).der() + b'\x01'
+        other = private_key.sign(z + 1).der() + b'\x01'
+        # OP_CHECKSIGVERIFY and a final OP_CHECKSIG go to the batch
+        for script in (Script([sig, sec, 0xac]), Script([sig, sec, 0xad, 0x51])):
+            batch = []
+            self.assertTrue(script.evaluate(z, None, batch))
+            self.assertEqual(len(batch), 1)
+        # OP_NOT needs the result of OP_CHECKSIG, so it's checked right away
+        script = Script([other, sec, 0xac, 0x91])
+        batch = []
+        self.assertTrue(script.evaluate(z, None))
+        self.assertTrue(script.evaluate(z, None, batch))
+        self.assertEqual(batch, [])
@@ -1,10 +1,21 @@
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
+from tempfile import TemporaryDirectory
+from time import sleep
 from unittest import TestCase
 
+import asyncio
+import hashlib
 import json
+import mmap
+import os
 import requests
+import struct
+import threading
 
-from ecc import PrivateKey
+from ecc import PrivateKey, S256Point, Signature, first_invalid, verify_batch
 from helper import (
     encode_varint,
     hash256,
@@ -16,37 +27,277 @@ from helper import (
 from script import p2pkh_script, Script
 
 
+# concurrent requests of TxFetcher.fetch_many
+FETCH_WORKERS = 8
+
+
+class TxStore(Mapping):
+    '''Raw transactions on disk, keyed by hex tx id.
+
+    filename holds the records back to back: the 32 byte tx id, the
+    4 byte length and the serialization. filename + '.idx' starts with
+    the number of sorted entries, followed by (tx id, offset, length)
+    entries, first the sorted ones, which are binary searched in place,
+    then the ones appended since the last compaction, which are read
+    into a dict on open. Both files are memory-mapped and a transaction
+    is only parsed when it is asked for.'''
+
+    HEADER = struct.Struct('<Q')
+    ENTRY = struct.Struct('<32sQL')
+    RECORD = struct.Struct('<32sL')
+    # appended entries that opening or closing merges into the sorted part
+    compact_size = 4096
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + '.idx'
+        self.parsed = {}
+        # reentrant, since put_raw and compact look entries up
+        self.lock = threading.RLock()
+        # append mode, so every write goes to the end of the file
+        self.data = open(filename, 'a+b')
+        if not os.path.exists(self.index_filename):
+            self.rebuild_index()
+        self.index = open(self.index_filename, 'r+b')
+        self.data_map = None
+        self.remap()
+        self.load_index()
+        # a store that wasn't closed can have any number of appended entries
+        if len(self.unsorted) > self.compact_size:
+            self.compact()
+
+    def remap(self):
+        size = os.fstat(self.data.fileno()).st_size
+        # an empty file can't be mapped
+        if size:
+            with self.lock:
+                if self.data_map is not None:
+                    self.data_map.close()
+                self.data_map = mmap.mmap(self.data.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load_index(self):
+        self.index_map = mmap.mmap(self.index.fileno(), 0, access=mmap.ACCESS_READ)
+        self.sorted_count, = self.HEADER.unpack_from(self.index_map)
+        self.unsorted = {}
+        data_size = len(self.data_map) if self.data_map is not None else 0
+        start = self.HEADER.size + self.sorted_count * self.ENTRY.size
+        for tx_hash, offset, length in self.ENTRY.iter_unpack(self.index_map[start:]):
+            # an entry whose record didn't make it to disk is dropped
+            if offset + length <= data_size:
+                self.unsorted[tx_hash] = (offset, length)
+
+    def rebuild_index(self):
+        '''Writes a sorted index of every record in the data file'''
+        self.data.seek(0)
+        raw = self.data.read()
+        entries = []
+        offset = 0
+        while offset + self.RECORD.size <= len(raw):
+            tx_hash, length = self.RECORD.unpack_from(raw, offset)
+            offset += self.RECORD.size
+            if offset + length > len(raw):
+                break
+            entries.append((tx_hash, offset, length))
+            offset += length
+        self.write_index(entries)
+
+    def write_index(self, entries):
+        entries = sorted(dict((e[0], e) for e in entries).values())
+        tmp = self.index_filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(len(entries)))
+            for entry in entries:
+                f.write(self.ENTRY.pack(*entry))
+        os.replace(tmp, self.index_filename)
+
+    def compact(self):
+        '''Merges the appended entries into the sorted part of the index'''
+        with self.lock:
+            entries = [self.ENTRY.unpack_from(self.index_map, self.HEADER.size + i * self.ENTRY.size)
+                       for i in range(self.sorted_count)]
+            entries.extend((k, offset, length) for k, (offset, length) in self.unsorted.items())
+            self.index_map.close()
+            self.index.close()
+            self.write_index(entries)
+            self.index = open(self.index_filename, 'r+b')
+            self.load_index()
+
+    def close(self):
+        if len(self.unsorted) > self.compact_size:
+            self.compact()
+        self.index_map.close()
+        self.index.close()
+        if self.data_map is not None:
+            self.data_map.close()
+        self.data.close()
+
+    def find(self, tx_hash):
+        '''Returns (offset, length) of the record for the 32 byte tx id'''
+        with self.lock:
+            if tx_hash in self.unsorted:
+                return self.unsorted[tx_hash]
+            index_map, entry_size = self.index_map, self.ENTRY.size
+            lo, hi = 0, self.sorted_count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = self.HEADER.size + mid * entry_size
+                if index_map[start:start + 32] < tx_hash:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < self.sorted_count:
+                found, offset, length = self.ENTRY.unpack_from(index_map, self.HEADER.size + lo * entry_size)
+                if found == tx_hash:
+                    return offset, length
+            return None
+
+    def get_raw(self, tx_id):
+        '''Returns the serialization of tx_id, or None if it isn't stored'''
+        location = self.find(bytes.fromhex(tx_id))
+        if location is None:
+            return None
+        offset, length = location
+        # the map is only replaced under the lock, so read it under it too
+        with self.lock:
+            if self.data_map is None or offset + length > len(self.data_map):
+                self.remap()
+            return self.data_map[offset:offset + length]
+
+    def put_raw(self, tx_id, raw):
+        tx_hash = bytes.fromhex(tx_id)
+        with self.lock:
+            if self.find(tx_hash) is not None:
+                return
+            self.data.write(self.RECORD.pack(tx_hash, len(raw)))
+            offset = self.data.tell()
+            self.data.write(raw)
+            # the record has to be on disk before the index points to it
+            self.data.flush()
+            self.index.seek(0, os.SEEK_END)
+            self.index.write(self.ENTRY.pack(tx_hash, offset, len(raw)))
+            self.index.flush()
+            self.unsorted[tx_hash] = (offset, len(raw))
+
+    def migrate(self, filename):
+        '''Copies every transaction of a JSON cache written by
+        TxFetcher.dump_cache, without parsing them'''
+        with open(filename, 'r') as f:
+            disk_cache = json.load(f)
+        for tx_id, raw_hex in sorted(disk_cache.items()):
+            self.put_raw(tx_id, bytes.fromhex(raw_hex))
+        self.compact()
+
+    def __getitem__(self, tx_id):
+        if tx_id not in self.parsed:
+            raw = self.get_raw(tx_id)
+            if raw is None:
+                raise KeyError(tx_id)
+            self.parsed[tx_id] = Tx.parse(BytesIO(raw))
+        return self.parsed[tx_id]
+
+    def __setitem__(self, tx_id, tx):
+        self.put_raw(tx_id, tx.serialized())
+        self.parsed[tx_id] = tx
+
+    def __contains__(self, tx_id):
+        return tx_id in self.parsed or self.find(bytes.fromhex(tx_id)) is not None
+
+    def __len__(self):
+        return self.sorted_count + len(self.unsorted)
+
+    def __iter__(self):
+        for i in range(self.sorted_count):
+            start = self.HEADER.size + i * self.ENTRY.size
+            yield self.index_map[start:start + 32].hex()
+        for tx_hash in self.unsorted:
+            yield tx_hash.hex()
+
+
 class TxFetcher:
     cache = {}
+    session = None
+    timeout = 30
+    # a server to ask instead, for both networks
+    base_url = None
 
     @classmethod
     def get_url(cls, testnet=False):
+        if cls.base_url is not None:
+            return cls.base_url
         if testnet:
             return 'http://testnet.programmingbitcoin.com'
         else:
             return 'http://mainnet.programmingbitcoin.com'
 
+    @classmethod
+    def get_session(cls):
+        '''One requests.Session for every request, so connections to the
+        server are kept open and shared by the fetch_many threads'''
+        if cls.session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=FETCH_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls.session = session
+        return cls.session
+
+    @classmethod
+    def parse_response(cls, tx_id, text, testnet=False):
+        '''Parses the hex a server sent for tx_id and checks its hash'''
+        try:
+            raw = bytes.fromhex(text.strip())
+        except ValueError:
+            raise ValueError('unexpected response: {}'.format(text))
+        tx = Tx.parse(BytesIO(raw), testnet=testnet)
+        # make sure the tx we got matches to the hash we requested
+        if tx.segwit:
+            computed = tx.id()
+        else:
+            computed = hash256(raw)[::-1].hex()
+        if computed != tx_id:
+            raise RuntimeError('server lied: {} vs {}'.format(computed, tx_id))
+        return tx
+
+    @classmethod
+    def download(cls, tx_id, testnet=False, timeout=None):
+        url = '{}/tx/{}.hex'.format(cls.get_url(testnet), tx_id)
+        if timeout is None:
+            timeout = cls.timeout
+        response = cls.get_session().get(url, timeout=timeout)
+        return cls.parse_response(tx_id, response.text, testnet)
+
     @classmethod
     def fetch(cls, tx_id, testnet=False, fresh=False):
         if fresh or (tx_id not in cls.cache):
-            url = '{}/tx/{}.hex'.format(cls.get_url(testnet), tx_id)
-            response = requests.get(url)
-            try:
-                raw = bytes.fromhex(response.text.strip())
-            except ValueError:
-                raise ValueError('unexpected response: {}'.format(response.text))
-            tx = Tx.parse(BytesIO(raw), testnet=testnet)
-            # make sure the tx we got matches to the hash we requested
-            if tx.segwit:
-                computed = tx.id()
-            else:
-                computed = hash256(raw)[::-1].hex()
-            if computed != tx_id:
-                raise RuntimeError('server lied: {} vs {}'.format(computed, tx_id))
-            cls.cache[tx_id] = tx
+            cls.cache[tx_id] = cls.download(tx_id, testnet)
         cls.cache[tx_id].testnet = testnet
         return cls.cache[tx_id]
 
+    @classmethod
+    def fetch_many(cls, tx_ids, testnet=False, fresh=False, max_workers=FETCH_WORKERS):
+        '''Returns the transactions of tx_ids in order. The ones that
+        aren't cached are downloaded concurrently, each only once.'''
+        tx_ids = list(tx_ids)
+        missing = [tx_id for tx_id in dict.fromkeys(tx_ids)
+                   if fresh or tx_id not in cls.cache]
+        if missing:
+            workers = min(max_workers, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                downloads = executor.map(lambda tx_id: cls.download(tx_id, testnet), missing)
+                for tx_id, tx in zip(missing, downloads):
+                    cls.cache[tx_id] = tx
+        return [cls.fetch(tx_id, testnet) for tx_id in tx_ids]
+
+    @classmethod
+    def open_store(cls, filename, legacy_filename=None):
+        '''Uses a TxStore as the cache. A new store is first filled from
+        the JSON cache legacy_filename, if there is one.'''
+        store = TxStore(filename)
+        if len(store) == 0 and legacy_filename is not None and os.path.exists(legacy_filename):
+            store.migrate(legacy_filename)
+        cls.cache = store
+        return store
+
     @classmethod
     def load_cache(cls, filename):
         disk_cache = json.loads(open(filename, 'r').read())
@@ -56,11 +307,77 @@ class TxFetcher:
     @classmethod
     def dump_cache(cls, filename):
         with open(filename, 'w') as f:
-            to_dump = {k: tx.serialize().hex() for k, tx in cls.cache.items()}
+            to_dump = {k: tx.serialized().hex() for k, tx in cls.cache.items()}
             s = json.dumps(to_dump, sort_keys=True, indent=4)
             f.write(s)
 
 
+class AsyncTxFetcher:
+    '''TxFetcher.fetch for asyncio applications.
+
+    Callers that ask for the same transaction while it's being
+    downloaded all wait for that one download. At most max_concurrent
+    downloads run at a time, each in a thread that holds its slot until
+    it returns. timeout is the requests timeout, so a server that stops
+    answering for that long ends the thread. Connection errors and
+    timeouts are retried with exponential backoff. Downloads go through
+    fetcher.download, so the hash is checked as in fetch, and land in
+    fetcher.cache.'''
+
+    def __init__(self, fetcher=TxFetcher, max_concurrent=FETCH_WORKERS,
+                 timeout=None, retries=2, backoff=0.5):
+        self.fetcher = fetcher
+        self.max_concurrent = max_concurrent
+        self.timeout = fetcher.timeout if timeout is None else timeout
+        self.retries = retries
+        self.backoff = backoff
+        # the semaphore and futures belong to the loop they were made in
+        self.loop = None
+        self.semaphore = None
+        # (tx id, testnet) -> the future of its download
+        self.pending = {}
+
+    def bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+            self.pending = {}
+
+    async def fetch(self, tx_id, testnet=False, fresh=False):
+        self.bind_loop()
+        cache = self.fetcher.cache
+        if fresh or tx_id not in cache:
+            key = (tx_id, testnet)
+            future = self.pending.get(key)
+            if future is None:
+                future = asyncio.ensure_future(self.download(tx_id, testnet))
+                self.pending[key] = future
+                future.add_done_callback(lambda _: self.pending.pop(key, None))
+            # a caller that gets cancelled doesn't cancel the others
+            tx = await asyncio.shield(future)
+        else:
+            tx = cache[tx_id]
+        tx.testnet = testnet
+        return tx
+
+    async def fetch_many(self, tx_ids, testnet=False):
+        return await asyncio.gather(*(self.fetch(tx_id, testnet) for tx_id in tx_ids))
+
+    async def download(self, tx_id, testnet=False):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    tx = await asyncio.to_thread(self.fetcher.download, tx_id, testnet, self.timeout)
+            except requests.RequestException:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2**attempt)
+            else:
+                self.fetcher.cache[tx_id] = tx
+                return tx
+
+
 # tag::source1[]
 class Tx:
     command = b'tx'
@@ -78,6 +395,13 @@ class Tx:
         self._hash_outputs = None
     # end::source1[]
 
+    # filled in on first use and cleared by invalidate()
+    _sig_hash_context = None
+    _serialized_legacy = None
+    _serialized = None
+    _hash = None
+    _witness_hash = None
+
     def __repr__(self):
         tx_ins = ''
         for tx_in in self.tx_ins:
@@ -94,8 +418,11 @@ class Tx:
         )
 
     def id(self):
-        '''Human-readable hexadecimal of the transaction hash'''
-        return self.hash().hex()
+        '''Human-readable hexadecimal of the transaction hash
+        The hash is computed once and kept until invalidate()'''
+        if self._hash is None:
+            self._hash = hash256(self.serialized_legacy())[::-1]
+        return self._hash.hex()
 
     # tag::source5[]
     def hash(self):
@@ -103,6 +430,31 @@ class Tx:
         return hash256(self.serialize_legacy())[::-1]
     # end::source5[]
 
+    def wtxid(self):
+        '''Human-readable hexadecimal of the witness hash'''
+        return self.witness_hash().hex()
+
+    def witness_hash(self):
+        '''Binary hash of the full serialization, which is the same as
+        hash() for a transaction without witnesses'''
+        if self._witness_hash is None:
+            self._witness_hash = hash256(self.serialized())[::-1]
+        return self._witness_hash
+
+    def invalidate(self, scripts_only=False):
+        '''Forgets the cached serializations and hashes. Call it after
+        changing the transaction. With scripts_only=True only ScriptSigs or
+        witnesses have changed, so the signature hash caches are kept.'''
+        self._serialized_legacy = None
+        self._serialized = None
+        self._hash = None
+        self._witness_hash = None
+        if not scripts_only:
+            self._hash_prevouts = None
+            self._hash_sequence = None
+            self._hash_outputs = None
+            self._sig_hash_context = None
+
     # tag::source2[]
     @classmethod
     def parse(cls, s, testnet=False):
@@ -198,6 +550,52 @@ class Tx:
         return result
     # end::source4[]
 
+    def serialized_legacy(self):
+        '''Same bytes as serialize_legacy(), written into one bytearray
+        and kept until invalidate()'''
+        if self._serialized_legacy is None:
+            result = bytearray(int_to_little_endian(self.version, 4))
+            self.write_body(result)
+            result += int_to_little_endian(self.locktime, 4)
+            self._serialized_legacy = bytes(result)
+        return self._serialized_legacy
+
+    def serialized(self):
+        '''Same bytes as serialize(), written into one bytearray
+        and kept until invalidate()'''
+        if not self.segwit:
+            return self.serialized_legacy()
+        if self._serialized is None:
+            result = bytearray(int_to_little_endian(self.version, 4))
+            result += b'\x00\x01'
+            self.write_body(result)
+            for tx_in in self.tx_ins:
+                result += int_to_little_endian(len(tx_in.witness), 1)
+                for item in tx_in.witness:
+                    if type(item) == int:
+                        result += int_to_little_endian(item, 1)
+                    else:
+                        result += encode_varint(len(item))
+                        result += item
+            result += int_to_little_endian(self.locktime, 4)
+            self._serialized = bytes(result)
+        return self._serialized
+
+    def write_body(self, out):
+        '''Appends the inputs and outputs to the bytearray out'''
+        out += encode_varint(len(self.tx_ins))
+        for tx_in in self.tx_ins:
+            tx_in.write(out)
+        out += encode_varint(len(self.tx_outs))
+        for tx_out in self.tx_outs:
+            tx_out.write(out)
+
+    def prefetch_inputs(self):
+        '''Fetches the previous transactions of every input at once'''
+        if self.is_coinbase():
+            return
+        TxFetcher.fetch_many([tx_in.prev_tx.hex() for tx_in in self.tx_ins], testnet=self.testnet)
+
     def fee(self):
         '''Returns the fee of this transaction in satoshi'''
         # initialize input sum and output sum
@@ -214,44 +612,18 @@ class Tx:
     def sig_hash(self, input_index, redeem_script=None):
         '''Returns the integer representation of the hash that needs to get
         signed for index input_index'''
-        # start the serialization with version
-        # use int_to_little_endian in 4 bytes
-        s = int_to_little_endian(self.version, 4)
-        # add how many inputs there are using encode_varint
-        s += encode_varint(len(self.tx_ins))
-        # loop through each input using enumerate, so we have the input index
-        for i, tx_in in enumerate(self.tx_ins):
-            # if the input index is the one we're signing
-            if i == input_index:
-                # if the RedeemScript was passed in, that's the ScriptSig
-                if redeem_script:
-                    script_sig = redeem_script
-                # otherwise the previous tx's ScriptPubkey is the ScriptSig
-                else:
-                    script_sig = tx_in.script_pubkey(self.testnet)
-            # Otherwise, the ScriptSig is empty
-            else:
-                script_sig = None
-            # add the serialization of the input with the ScriptSig we want
-            s += TxIn(
-                prev_tx=tx_in.prev_tx,
-                prev_index=tx_in.prev_index,
-                script_sig=script_sig,
-                sequence=tx_in.sequence,
-            ).serialize()
-        # add how many outputs there are using encode_varint
-        s += encode_varint(len(self.tx_outs))
-        # add the serialization of each output
-        for tx_out in self.tx_outs:
-            s += tx_out.serialize()
-        # add the locktime using int_to_little_endian in 4 bytes
-        s += int_to_little_endian(self.locktime, 4)
-        # add SIGHASH_ALL using int_to_little_endian in 4 bytes
-        s += int_to_little_endian(SIGHASH_ALL, 4)
-        # hash256 the serialization
-        h256 = hash256(s)
-        # convert the result to an integer using int.from_bytes(x, 'big')
-        return int.from_bytes(h256, 'big')
+        # if the RedeemScript was passed in, that's the ScriptSig
+        if redeem_script:
+            script_sig = redeem_script
+        # otherwise the previous tx's ScriptPubkey is the ScriptSig
+        else:
+            script_sig = self.tx_ins[input_index].script_pubkey(self.testnet)
+        return self.sig_hash_context().sig_hash(input_index, script_sig)
+
+    def sig_hash_context(self):
+        if self._sig_hash_context is None:
+            self._sig_hash_context = SigHashContext(self)
+        return self._sig_hash_context
 
     def hash_prevouts(self):
         if self._hash_prevouts is None:
@@ -299,8 +671,10 @@ class Tx:
         s += int_to_little_endian(SIGHASH_ALL, 4)
         return int.from_bytes(hash256(s), 'big')
 
-    def verify_input(self, input_index):
-        '''Returns whether the input has a valid signature'''
+    def verify_input(self, input_index, batch=None):
+        '''Returns whether the input has a valid signature
+        If batch is a list, signature checks are appended to it
+        instead of being done here'''
         # get the relevant input
         tx_in = self.tx_ins[input_index]
         # grab the previous ScriptPubKey
@@ -342,17 +716,27 @@ class Tx:
         # combine the current ScriptSig and the previous ScriptPubKey
         combined = tx_in.script_sig + script_pubkey
         # evaluate the combined script
-        return combined.evaluate(z, witness)
-
-    def verify(self):
-        '''Verify this transaction'''
+        return combined.evaluate(z, witness, batch)
+
+    def verify(self, batch=False, executor=None):
+        '''Verify this transaction
+        With batch=True the signatures of all inputs are collected while
+        the scripts run and then checked together with verify_batch.
+        With an executor the signatures are checked by verify_parallel.'''
+        # every input needs its previous transaction, get them in one round
+        self.prefetch_inputs()
+        if executor is not None:
+            return verify_parallel([self], executor)
         # check that we're not creating money
         if self.fee() < 0:
             return False
+        items = [] if batch else None
         # check that each input has a valid ScriptSig
         for i in range(len(self.tx_ins)):
-            if not self.verify_input(i):
+            if not self.verify_input(i, items):
                 return False
+        if batch:
+            return verify_batch(items)
         return True
 
     def sign_input(self, input_index, private_key):
@@ -369,9 +753,28 @@ class Tx:
         script_sig = Script([sig, sec])
         # change input's script_sig to new script
         self.tx_ins[input_index].script_sig = script_sig
+        self.invalidate(scripts_only=True)
         # return whether sig is valid using self.verify_input
         return self.verify_input(input_index)
 
+    def sign_all(self, private_key):
+        '''Signs every input with the same private key, like sign_input,
+        but with the nonces and signatures computed by sign_many'''
+        self.prefetch_inputs()
+        zs = [self.sig_hash(i) for i in range(len(self.tx_ins))]
+        sigs = private_key.sign_many(zs)
+        sec = private_key.point.sec()
+        for tx_in, sig in zip(self.tx_ins, sigs):
+            der = sig.der()
+            tx_in.script_sig = Script([der + SIGHASH_ALL.to_bytes(1, 'big'), sec])
+        self.invalidate(scripts_only=True)
+        # check all the new signatures together
+        items = []
+        for i in range(len(self.tx_ins)):
+            if not self.verify_input(i, items):
+                return False
+        return verify_batch(items)
+
     def is_coinbase(self):
         '''Returns whether this transaction is a coinbase transaction or not'''
         # check that there is exactly 1 input
@@ -400,6 +803,52 @@ class Tx:
         return little_endian_to_int(first_cmd)
 
 
+class SigHashContext:
+    '''What every legacy SIGHASH_ALL preimage of a transaction shares.
+
+    The preimage of input i is the transaction with input i's ScriptSig
+    replaced and every other ScriptSig empty. The version, the inputs
+    with empty ScriptSigs and the outputs are serialized once here, and
+    sig_hash feeds slices of them to the hash around the one input that
+    differs, instead of building a new transaction per input.
+    Only ScriptSigs may change after it's made.'''
+
+    def __init__(self, tx):
+        self.head = int_to_little_endian(tx.version, 4) + encode_varint(len(tx.tx_ins))
+        self.outpoints = []
+        self.sequences = []
+        # offsets[i] is where input i starts in blank_inputs
+        self.offsets = [0]
+        blank_inputs = bytearray()
+        for tx_in in tx.tx_ins:
+            outpoint = tx_in.prev_tx[::-1] + int_to_little_endian(tx_in.prev_index, 4)
+            sequence = int_to_little_endian(tx_in.sequence, 4)
+            self.outpoints.append(outpoint)
+            self.sequences.append(sequence)
+            # an empty ScriptSig is a zero length
+            blank_inputs += outpoint + b'\x00' + sequence
+            self.offsets.append(len(blank_inputs))
+        self.blank_inputs = memoryview(bytes(blank_inputs))
+        tail = bytearray(encode_varint(len(tx.tx_outs)))
+        for tx_out in tx.tx_outs:
+            tail += tx_out.serialize()
+        tail += int_to_little_endian(tx.locktime, 4)
+        tail += int_to_little_endian(SIGHASH_ALL, 4)
+        self.tail = bytes(tail)
+
+    def sig_hash(self, input_index, script_sig):
+        '''The signature hash of input_index signing script_sig'''
+        h = hashlib.sha256(self.head)
+        h.update(self.blank_inputs[:self.offsets[input_index]])
+        h.update(self.outpoints[input_index])
+        h.update(script_sig.serialize())
+        h.update(self.sequences[input_index])
+        h.update(self.blank_inputs[self.offsets[input_index + 1]:])
+        h.update(self.tail)
+        h256 = hashlib.sha256(h.digest()).digest()
+        return int.from_bytes(h256, 'big')
+
+
 class TxIn:
 
     def __init__(self, prev_tx, prev_index, script_sig=None, sequence=0xffffffff):
@@ -435,15 +884,20 @@ class TxIn:
 
     def serialize(self):
         '''Returns the byte serialization of the transaction input'''
+        result = bytearray()
+        self.write(result)
+        return bytes(result)
+
+    def write(self, out):
+        '''Appends the serialization to the bytearray out'''
         # serialize prev_tx, little endian
-        result = self.prev_tx[::-1]
+        out += self.prev_tx[::-1]
         # serialize prev_index, 4 bytes, little endian
-        result += int_to_little_endian(self.prev_index, 4)
+        out += int_to_little_endian(self.prev_index, 4)
         # serialize the script_sig
-        result += self.script_sig.serialize()
+        self.script_sig.write(out)
         # serialize sequence, 4 bytes, little endian
-        result += int_to_little_endian(self.sequence, 4)
-        return result
+        out += int_to_little_endian(self.sequence, 4)
 
     def fetch_tx(self, testnet=False):
         return TxFetcher.fetch(self.prev_tx.hex(), testnet=testnet)
@@ -492,11 +946,88 @@ class TxOut:
 
     def serialize(self):
         '''Returns the byte serialization of the transaction output'''
+        result = bytearray()
+        self.write(result)
+        return bytes(result)
+
+    def write(self, out):
+        '''Appends the serialization to the bytearray out'''
         # serialize amount, 8 bytes, little endian
-        result = int_to_little_endian(self.amount, 8)
+        out += int_to_little_endian(self.amount, 8)
         # serialize the script_pubkey
-        result += self.script_pubkey.serialize()
-        return result
+        self.script_pubkey.write(out)
+
+
+# how many signatures a verify_parallel worker checks per task
+VERIFY_CHUNK_SIZE = 32
+
+
+def verify_signatures(chunk):
+    '''Checks a list of (z, sec, der) triples in a worker process.
+    Only these bytes and ints cross the process boundary, not Tx objects.'''
+    items = [(S256Point.parse(sec), z, Signature.parse(der)) for z, sec, der in chunk]
+    return verify_batch(items)
+
+
+def verify_parallel(txs, executor, chunk_size=VERIFY_CHUNK_SIZE):
+    '''Verifies transactions, such as all of a block's, with the signature
+    checks spread over executor (usually a ProcessPoolExecutor).
+    Scripts run here in batch mode; every chunk_size signatures go to a
+    worker while the next scripts run. A chunk that fails, or whose
+    worker raises, is checked again here one signature at a time.
+    Returns False as soon as a script or a chunk fails and cancels the
+    chunks that haven't started.'''
+    futures = []
+    items = []
+    # the (point, z, sig) items each future checks, for the serial check
+    chunks = {}
+
+    def passed(future):
+        try:
+            if future.result():
+                return True
+        except Exception:
+            # a broken worker isn't a bad signature
+            pass
+        return first_invalid(chunks[future]) is None
+
+    def submit(chunk_items):
+        # the bytes from the script, since a signature that parses
+        # doesn't always serialize again
+        chunk = [(z, sec, der) for _, z, _, sec, der in chunk_items]
+        future = executor.submit(verify_signatures, chunk)
+        chunks[future] = chunk_items
+        futures.append(future)
+
+    def failed():
+        return any(f.done() and not passed(f) for f in futures)
+
+    try:
+        for tx in txs:
+            tx.prefetch_inputs()
+            if tx.fee() < 0:
+                return False
+            for i in range(len(tx.tx_ins)):
+                if not tx.verify_input(i, items):
+                    return False
+                while len(items) >= chunk_size:
+                    submit(items[:chunk_size])
+                    del items[:chunk_size]
+            if failed():
+                return False
+        if items:
+            submit(items)
+        # every chunk has to pass, so the answer doesn't depend on the order
+        # the workers finish in; the first failure ends the wait
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if not all(passed(future) for future in done):
+                return False
+        return True
+    finally:
+        for future in futures:
+            future.cancel()
 
 
 class TxTest(TestCase):
@@ -556,6 +1087,32 @@ class TxTest(TestCase):
         tx = Tx.parse(stream)
         self.assertEqual(tx.serialize(), raw_tx)
 
+    def test_serialize_cache(self):
+        tx = TxFetcher.fetch('d869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c', testnet=True)
+        self.assertTrue(tx.segwit)
+        self.assertIs(tx.serialized(), tx.serialized())
+        self.assertEqual(tx.serialized(), tx.serialize())
+        self.assertEqual(tx.serialized_legacy(), tx.serialize_legacy())
+        self.assertEqual(tx.id(), tx.hash().hex())
+        self.assertEqual(tx.wtxid(), hash256(tx.serialize())[::-1].hex())
+        self.assertNotEqual(tx.wtxid(), tx.id())
+        # signing changes the serialization and the id
+        private_key = PrivateKey(secret=8675309)
+        tx = Tx.parse(BytesIO(bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000')), testnet=True)
+        unsigned = tx.id()
+        self.assertEqual(tx.wtxid(), unsigned)
+        context = tx.sig_hash_context()
+        self.assertTrue(tx.sign_input(0, private_key))
+        self.assertNotEqual(tx.id(), unsigned)
+        self.assertEqual(tx.id(), tx.hash().hex())
+        self.assertEqual(tx.serialized(), tx.serialize())
+        self.assertIs(tx.sig_hash_context(), context)
+        tx.tx_outs.pop()
+        tx.invalidate()
+        self.assertIsNot(tx.sig_hash_context(), context)
+        self.assertEqual(tx.serialized(), tx.serialize())
+        self.assertEqual(len(tx.serialized()), len(tx.tx_ins[0].serialize()) + len(tx.tx_outs[0].serialize()) + 10)
+
     def test_input_value(self):
         tx_hash = 'd1c789a9c60383bf715f3f6ad9d14b91fe55f3deb369fe5d9280cb1a01793f81'
         index = 0
@@ -585,6 +1142,20 @@ class TxTest(TestCase):
         want = int('27e0c5994dec7824e56dec6b2fcb342eb7cdb0d0957c2fce9882f715e85d81a6', 16)
         self.assertEqual(tx.sig_hash(0), want)
 
+    def test_sig_hash_context(self):
+        tx = TxFetcher.fetch('22874d30bde689475e1df03608aa85a3c7b01e18f8d53aedc1b6df6ded788286')
+        redeem_script = p2pkh_script(bytes(20))
+        context = tx.sig_hash_context()
+        self.assertIs(tx.sig_hash_context(), context)
+        for i in (0, 1, 50, len(tx.tx_ins) - 1):
+            # the transaction with only input i's ScriptSig filled in
+            tx_ins = [TxIn(tx_in.prev_tx, tx_in.prev_index, redeem_script if j == i else None, tx_in.sequence)
+                      for j, tx_in in enumerate(tx.tx_ins)]
+            modified = Tx(tx.version, tx_ins, tx.tx_outs, tx.locktime)
+            want = int.from_bytes(hash256(modified.serialize_legacy() + int_to_little_endian(SIGHASH_ALL, 4)), 'big')
+            self.assertEqual(context.sig_hash(i, redeem_script), want)
+            self.assertEqual(tx.sig_hash(i, redeem_script), want)
+
     def test_verify_p2pkh(self):
         tx = TxFetcher.fetch('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03')
         self.assertTrue(tx.verify())
@@ -611,6 +1182,62 @@ class TxTest(TestCase):
         tx = TxFetcher.fetch('954f43dbb30ad8024981c07d1f5eb6c9fd461e2cf1760dd1283f052af746fc88', testnet=True)
         self.assertTrue(tx.verify())
 
+    def test_verify_batch(self):
+        tx_ids = (
+            ('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03', False),
+            ('46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b', False),
+            ('d869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c', True),
+            ('954f43dbb30ad8024981c07d1f5eb6c9fd461e2cf1760dd1283f052af746fc88', True),
+        )
+        for tx_id, testnet in tx_ids:
+            tx = TxFetcher.fetch(tx_id, testnet=testnet)
+            self.assertTrue(tx.verify(batch=True))
+        # a bad signature only shows up when the batch is verified
+        tx = TxFetcher.fetch('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03')
+        tx = Tx.parse(BytesIO(tx.serialize()))
+        tx.locktime += 1
+        self.assertFalse(tx.verify(batch=True))
+
+    def test_verify_parallel(self):
+        tx_ids = (
+            ('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03', False),
+            ('46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b', False),
+            ('d869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c', True),
+            ('954f43dbb30ad8024981c07d1f5eb6c9fd461e2cf1760dd1283f052af746fc88', True),
+        )
+        txs = [TxFetcher.fetch(tx_id, testnet=testnet) for tx_id, testnet in tx_ids]
+        bad = Tx.parse(BytesIO(txs[0].serialize()))
+        bad.locktime += 1
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            # chunks of one signature so every input goes to a worker
+            self.assertTrue(verify_parallel(txs, executor, chunk_size=1))
+            self.assertTrue(txs[0].verify(executor=executor))
+            self.assertFalse(verify_parallel(txs + [bad], executor, chunk_size=1))
+            self.assertFalse(bad.verify(executor=executor))
+            # an r of 33 bytes parses, but doesn't fit der()
+            bad = Tx.parse(BytesIO(txs[0].serialize()))
+            script_sig = bad.tx_ins[0].script_sig
+            r, s = b'\x01' + b'\xff' * 32, b'\x01'
+            der = bytes([0x30, len(r) + len(s) + 4, 2, len(r)]) + r + bytes([2, len(s)]) + s
+            script_sig.cmds[0] = der + script_sig.cmds[0][-1:]
+            bad.invalidate(scripts_only=True)
+            self.assertFalse(verify_parallel([bad], executor, chunk_size=1))
+            self.assertFalse(bad.verify(batch=True))
+
+    def test_verify_parallel_broken_worker(self):
+        class BrokenExecutor(ThreadPoolExecutor):
+            def submit(self, fn, *args):
+                # every task raises instead of returning a result
+                return super().submit(int, 'not a number')
+
+        tx = TxFetcher.fetch('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03')
+        bad = Tx.parse(BytesIO(tx.serialize()))
+        bad.locktime += 1
+        with BrokenExecutor(max_workers=2) as executor:
+            # the chunks are checked here instead of raising
+            self.assertTrue(verify_parallel([tx], executor, chunk_size=1))
+            self.assertFalse(verify_parallel([tx, bad], executor, chunk_size=1))
+
     def test_sign_input(self):
         private_key = PrivateKey(secret=8675309)
         stream = BytesIO(bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'))
@@ -619,6 +1246,15 @@ class TxTest(TestCase):
         want = '010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d0000006b4830450221008ed46aa2cf12d6d81065bfabe903670165b538f65ee9a3385e6327d80c66d3b502203124f804410527497329ec4715e18558082d489b218677bd029e7fa306a72236012103935581e52c354cd2f484fe8ed83af7a3097005b2f9c60bff71d35bd795f54b67ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'
         self.assertEqual(tx_obj.serialize().hex(), want)
 
+    def test_sign_all(self):
+        private_key = PrivateKey(secret=8675309)
+        stream = BytesIO(bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'))
+        tx_obj = Tx.parse(stream, testnet=True)
+        self.assertTrue(tx_obj.sign_all(private_key))
+        # the same bytes as sign_input
+        want = '010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d0000006b4830450221008ed46aa2cf12d6d81065bfabe903670165b538f65ee9a3385e6327d80c66d3b502203124f804410527497329ec4715e18558082d489b218677bd029e7fa306a72236012103935581e52c354cd2f484fe8ed83af7a3097005b2f9c60bff71d35bd795f54b67ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'
+        self.assertEqual(tx_obj.serialize().hex(), want)
+
     def test_is_coinbase(self):
         raw_tx = bytes.fromhex('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff5e03d71b07254d696e656420627920416e74506f6f6c20626a31312f4542312f4144362f43205914293101fabe6d6d678e2c8c34afc36896e7d9402824ed38e856676ee94bfdb0c6c4bcd8b2e5666a0400000000000000c7270000a5e00e00ffffffff01faf20b58000000001976a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac00000000')
         stream = BytesIO(raw_tx)
@@ -634,3 +1270,243 @@ class TxTest(TestCase):
         stream = BytesIO(raw_tx)
         tx = Tx.parse(stream)
         self.assertIsNone(tx.coinbase_height())
+
+
+class TxStoreTest(TestCase):
+    cache_file = '../tx.cache'
+
+    def test_migrate(self):
+        with open(self.cache_file, 'r') as f:
+            disk_cache = json.load(f)
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'tx.store')
+            store = TxStore(filename)
+            store.migrate(self.cache_file)
+            self.assertEqual(len(store), len(disk_cache))
+            # migrating sorts the whole index
+            self.assertEqual(store.sorted_count, len(disk_cache))
+            store.close()
+            # nothing is parsed until it's asked for
+            store = TxStore(filename)
+            self.assertEqual(store.parsed, {})
+            self.assertEqual(sorted(store), sorted(disk_cache))
+            for tx_id, raw_hex in disk_cache.items():
+                self.assertIn(tx_id, store)
+                self.assertEqual(store.get_raw(tx_id).hex(), raw_hex)
+            tx_id = '452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03'
+            self.assertEqual(store[tx_id].id(), tx_id)
+            self.assertEqual(list(store.parsed), [tx_id])
+            self.assertNotIn('00' * 32, store)
+            with self.assertRaises(KeyError):
+                store['00' * 32]
+            store.close()
+            # the index can be rebuilt from the records
+            os.remove(filename + '.idx')
+            store = TxStore(filename)
+            self.assertEqual(sorted(store), sorted(disk_cache))
+            store.close()
+
+    def test_write_through(self):
+        raw_tx = bytes.fromhex('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff5e03d71b07254d696e656420627920416e74506f6f6c20626a31312f4542312f4144362f43205914293101fabe6d6d678e2c8c34afc36896e7d9402824ed38e856676ee94bfdb0c6c4bcd8b2e5666a0400000000000000c7270000a5e00e00ffffffff01faf20b58000000001976a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac00000000')
+        tx = Tx.parse(BytesIO(raw_tx))
+        cache = TxFetcher.cache
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'tx.store')
+            try:
+                store = TxFetcher.open_store(filename, self.cache_file)
+                count = len(store)
+                # fetch finds migrated transactions without going online
+                tx_id = 'd869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c'
+                self.assertEqual(TxFetcher.fetch(tx_id, testnet=True).id(), tx_id)
+                data_map = store.data_map
+                store[tx.id()] = tx
+                store[tx.id()] = tx
+                self.assertEqual(len(store), count + 1)
+                self.assertEqual(store.unsorted, {tx.hash(): store.find(tx.hash())})
+                # reading the new record maps the file again
+                self.assertEqual(store.get_raw(tx.id()), raw_tx)
+                self.assertTrue(data_map.closed)
+                store.close()
+                # the second open doesn't migrate again
+                store = TxFetcher.open_store(filename, self.cache_file)
+                self.assertEqual(len(store), count + 1)
+                self.assertEqual(store.get_raw(tx.id()), raw_tx)
+                store.close()
+
+                class SmallTxStore(TxStore):
+                    compact_size = 0
+
+                # entries appended in earlier sessions are merged on open
+                store = SmallTxStore(filename)
+                self.assertEqual(store.sorted_count, count + 1)
+                self.assertEqual(store.unsorted, {})
+                self.assertEqual(store.get_raw(tx.id()), raw_tx)
+                store.close()
+            finally:
+                TxFetcher.cache = cache
+
+
+class TxFetcherTest(TestCase):
+    cache_file = '../tx.cache'
+
+    @classmethod
+    def setUpClass(cls):
+        # a stand-in for programmingbitcoin.com with the transactions of
+        # tx.cache, which logs the tx ids it's asked for
+        with open(cls.cache_file, 'r') as f:
+            raw_txs = json.load(f)
+        requested = []
+        # tx id -> seconds to wait before each of the next answers
+        delays = {}
+        # requests being answered right now, and the most there have been
+        active = {'now': 0, 'most': 0}
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                tx_id = self.path[len('/tx/'):-len('.hex')]
+                requested.append(tx_id)
+                with lock:
+                    active['now'] += 1
+                    active['most'] = max(active['most'], active['now'])
+                try:
+                    self.answer(tx_id)
+                finally:
+                    with lock:
+                        active['now'] -= 1
+
+            def answer(self, tx_id):
+                if delays.get(tx_id):
+                    sleep(delays[tx_id].pop(0))
+                if tx_id in raw_txs:
+                    body = raw_txs[tx_id]
+                elif tx_id == 'ff' * 32:
+                    # a transaction, but not the one asked for
+                    body = next(iter(raw_txs.values()))
+                else:
+                    body = 'not found'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode('ascii'))
+
+            def log_message(self, *args):
+                pass
+
+        cls.raw_txs = raw_txs
+        cls.requested = requested
+        cls.delays = delays
+        cls.active = active
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.saved = TxFetcher.cache, TxFetcher.base_url, TxFetcher.session
+        TxFetcher.cache = {}
+        TxFetcher.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        TxFetcher.session = None
+        del self.requested[:]
+        self.delays.clear()
+        self.active['most'] = 0
+
+    def tearDown(self):
+        if TxFetcher.session is not None:
+            TxFetcher.session.close()
+        TxFetcher.cache, TxFetcher.base_url, TxFetcher.session = self.saved
+
+    def test_fetch_many(self):
+        tx_ids = sorted(self.raw_txs)
+        TxFetcher.fetch(tx_ids[0])
+        txs = TxFetcher.fetch_many(tx_ids + tx_ids[::-1], testnet=True, max_workers=4)
+        self.assertEqual([tx.id() for tx in txs], tx_ids + tx_ids[::-1])
+        self.assertTrue(all(tx.testnet for tx in txs))
+        # every tx id once, and the cached one not again
+        self.assertEqual(sorted(self.requested), tx_ids)
+        TxFetcher.fetch_many(tx_ids[:3], fresh=True)
+        self.assertEqual(len(self.requested), len(tx_ids) + 3)
+        with self.assertRaises(RuntimeError):
+            TxFetcher.fetch_many(['ff' * 32])
+        with self.assertRaises(ValueError):
+            TxFetcher.fetch_many(['ee' * 32])
+        self.assertNotIn('ff' * 32, TxFetcher.cache)
+
+    def test_prefetch_inputs(self):
+        # a sweep of output 0 of every transaction in tx.cache, some twice
+        tx_ids = sorted(self.raw_txs)
+        tx_ins = [TxIn(bytes.fromhex(tx_id), 0) for tx_id in tx_ids + tx_ids[:5]]
+        tx = Tx(1, tx_ins, [], 0, testnet=True)
+        tx.prefetch_inputs()
+        self.assertEqual(sorted(self.requested), tx_ids)
+        want = sum(Tx.parse(BytesIO(bytes.fromhex(self.raw_txs[tx_in.prev_tx.hex()]))).tx_outs[0].amount
+                   for tx_in in tx_ins)
+        self.assertEqual(tx.fee(), want)
+        self.assertEqual(len(self.requested), len(tx_ids))
+
+    def test_prefetch_sighash(self):
+        # each answer takes 0.2s, so the inputs fetched together are
+        # answered at the same time, and one at a time they never are
+        tx_ids = sorted(self.raw_txs)[:FETCH_WORKERS]
+        private_key = PrivateKey(secret=8675309)
+        for run in (lambda tx: tx.sign_all(private_key), lambda tx: tx.verify()):
+            TxFetcher.cache = {}
+            self.active['most'] = 0
+            del self.requested[:]
+            for tx_id in tx_ids:
+                self.delays[tx_id] = [0.2]
+            tx = Tx(1, [TxIn(bytes.fromhex(tx_id), 0) for tx_id in tx_ids], [], 0)
+            self.assertFalse(run(tx))
+            self.assertEqual(sorted(self.requested), tx_ids)
+            self.assertGreater(self.active['most'], 1)
+        # fee() fetches lazily, one input at a time
+        TxFetcher.cache = {}
+        self.active['most'] = 0
+        del self.requested[:]
+        tx = Tx(1, [TxIn(bytes.fromhex(tx_id), 0) for tx_id in tx_ids[:2]], [], 0)
+        tx.fee()
+        self.assertEqual(self.requested, tx_ids[:2])
+        self.assertEqual(self.active['most'], 1)
+
+    def test_async_fetch(self):
+        tx_ids = sorted(self.raw_txs)
+        fetcher = AsyncTxFetcher(max_concurrent=4)
+        self.delays[tx_ids[0]] = [0.2]
+
+        async def run():
+            # ten callers for the slow one, while the others download
+            return await asyncio.gather(
+                fetcher.fetch_many([tx_ids[0]] * 10, testnet=True),
+                fetcher.fetch_many(tx_ids[1:]))
+
+        slow, others = asyncio.run(run())
+        self.assertEqual(sorted(self.requested), tx_ids)
+        self.assertTrue(all(tx is slow[0] for tx in slow))
+        self.assertTrue(slow[0].testnet)
+        self.assertEqual([tx.id() for tx in others], tx_ids[1:])
+        self.assertEqual(fetcher.pending, {})
+        # the cache is TxFetcher's
+        self.assertIs(TxFetcher.fetch(tx_ids[0]), slow[0])
+        self.assertEqual(len(self.requested), len(tx_ids))
+        with self.assertRaises(RuntimeError):
+            asyncio.run(fetcher.fetch('ff' * 32))
+        # the same fetcher in a new loop, with downloads waiting for slots
+        TxFetcher.cache = {}
+        self.assertEqual([tx.id() for tx in asyncio.run(fetcher.fetch_many(tx_ids))], tx_ids)
+
+    def test_async_retry(self):
+        tx_id = sorted(self.raw_txs)[0]
+        self.delays[tx_id] = [0.5]
+        fetcher = AsyncTxFetcher(timeout=0.1, retries=1, backoff=0)
+        tx = asyncio.run(fetcher.fetch(tx_id))
+        self.assertEqual(tx.id(), tx_id)
+        self.assertEqual(self.requested, [tx_id, tx_id])
+        TxFetcher.cache = {}
+        self.delays[tx_id] = [0.5]
+        fetcher = AsyncTxFetcher(timeout=0.1, retries=0)
+        with self.assertRaises(requests.Timeout):
+            asyncio.run(fetcher.fetch(tx_id))
@@ -0,0 +1,192 @@
+'''Bulk and vanity address generation.
+
+Instead of a full scalar multiplication per key, consecutive secrets are
+walked by adding G to the previous point, and a whole batch of points is
+normalized to affine with one inversion. Worker processes each walk their
+own random range of secrets.
+
+Consecutive secrets are related: anyone who learns one of them can compute
+its neighbours. generate therefore starts a new random walk every RUN_SIZE
+keys, so a leaked key exposes at most the others of its run. Don't hand out
+keys of one run to different owners.
+
+    python vanity.py 1Bob        find a key whose address starts with 1Bob
+    python vanity.py -n 1000     print 1000 fresh (secret, address) pairs
+'''
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from secrets import randbelow
+from time import perf_counter
+from unittest import TestCase
+
+import os
+import sys
+
+from ecc import (
+    G,
+    N,
+    GeneratorTable,
+    PrivateKey,
+    S256Point,
+    jacobian_add_affine,
+    jacobian_batch_to_affine,
+)
+from helper import BASE58_ALPHABET
+
+
+# how many consecutive points share one batch inversion
+BATCH_SIZE = 1024
+# how many keys a worker checks per task
+CHUNK_SIZE = 2**16
+# how many consecutive secrets generate takes from one random start,
+# starting a walk costs about as much as a dozen keys of it
+RUN_SIZE = 256
+USAGE = '''usage: python vanity.py PREFIX     find a key whose address starts with PREFIX
+       python vanity.py -n COUNT   print COUNT fresh (secret, address) pairs'''
+
+
+def walk(start, count, batch_size=BATCH_SIZE):
+    '''Yields (secret, S256Point) for secrets start, start+1, ...
+    start+count-1, with one scalar multiplication for the whole walk'''
+    if start < 1 or start + count > N:
+        raise ValueError('secrets have to be between 1 and N-1')
+    g = G.jacobian()[:2]
+    current = GeneratorTable.multiply(start)
+    secret = start
+    while count > 0:
+        size = min(batch_size, count)
+        jacobians = []
+        for _ in range(size):
+            jacobians.append(current)
+            current = jacobian_add_affine(current, g)
+        for x, y in jacobian_batch_to_affine(jacobians):
+            yield secret, S256Point._unchecked(x, y)
+            secret += 1
+        count -= size
+
+
+def addresses(start, count, compressed=True, testnet=False):
+    '''Returns the (secret, address) pairs of count consecutive secrets'''
+    return [(secret, point.address(compressed, testnet))
+            for secret, point in walk(start, count)]
+
+
+def search(start, count, prefix, compressed=True, testnet=False):
+    '''Returns the (secret, address) pairs from start to start+count-1
+    whose address starts with prefix'''
+    return [(secret, address)
+            for secret, address in addresses(start, count, compressed, testnet)
+            if address.startswith(prefix)]
+
+
+def random_start(count):
+    '''A random secret with room for count keys after it'''
+    return randbelow(N - count - 1) + 1
+
+
+def find(prefix, executor, workers, compressed=True, testnet=False, chunk_size=CHUNK_SIZE):
+    '''Runs search on random ranges in executor until an address starts
+    with prefix. Returns (secret, address, keys checked, seconds).'''
+    if any(c not in BASE58_ALPHABET for c in prefix):
+        raise ValueError('{} is not base58'.format(prefix))
+    started = perf_counter()
+    checked = 0
+
+    def submit():
+        start = random_start(chunk_size)
+        return executor.submit(search, start, chunk_size, prefix, compressed, testnet)
+
+    pending = {submit() for _ in range(workers)}
+    try:
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                checked += chunk_size
+                matches = future.result()
+                if matches:
+                    secret, address = matches[0]
+                    return secret, address, checked, perf_counter() - started
+                pending.add(submit())
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def fresh_addresses(count, run_size=RUN_SIZE, compressed=True, testnet=False):
+    '''Returns count (secret, address) pairs in runs of run_size
+    consecutive secrets, each run from its own random start'''
+    result = []
+    while count > 0:
+        size = min(run_size, count)
+        result.extend(addresses(random_start(size), size, compressed, testnet))
+        count -= size
+    return result
+
+
+def generate(count, executor, compressed=True, testnet=False, chunk_size=CHUNK_SIZE, run_size=RUN_SIZE):
+    '''Yields count fresh (secret, address) pairs, computed in executor
+    in chunks of chunk_size. Only runs of run_size keys are consecutive
+    secrets, and a leaked key gives away the rest of its run.'''
+    sizes = [chunk_size] * (count // chunk_size)
+    if count % chunk_size:
+        sizes.append(count % chunk_size)
+    for chunk in executor.map(fresh_addresses, sizes, [run_size] * len(sizes),
+                              [compressed] * len(sizes), [testnet] * len(sizes)):
+        yield from chunk
+
+
+class VanityTest(TestCase):
+
+    def test_walk(self):
+        start = 2**200 + 12345
+        pairs = addresses(start, 20)
+        self.assertEqual([secret for secret, _ in pairs], list(range(start, start + 20)))
+        for secret, address in pairs:
+            self.assertEqual(address, PrivateKey(secret).point.address())
+        # secret 1 is G, so the first addition is a doubling
+        for secret, point in walk(1, 3, batch_size=2):
+            self.assertEqual(point, secret * G)
+        with self.assertRaises(ValueError):
+            list(walk(N - 1, 2))
+
+    def test_search(self):
+        matches = search(1, 50, '1', testnet=False)
+        self.assertEqual(len(matches), 50)
+        self.assertEqual(search(1, 50, 'm', testnet=False), [])
+        # every testnet p2pkh address starts with m or n
+        matches = search(1000, 50, 'n', testnet=True)
+        self.assertEqual(matches, [m for m in addresses(1000, 50, testnet=True) if m[1][0] == 'n'])
+
+    def test_find(self):
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            secret, address, checked, _ = find('1', executor, 2, chunk_size=16)
+            self.assertEqual(PrivateKey(secret).point.address(), address)
+            self.assertEqual(checked, 16)
+            pairs = list(generate(40, executor, testnet=True, chunk_size=16, run_size=4))
+        self.assertEqual(len(pairs), 40)
+        for secret, address in pairs[::13]:
+            self.assertEqual(PrivateKey(secret).point.address(testnet=True), address)
+        # runs of 4 consecutive secrets, each from a new random start
+        secrets = [secret for secret, _ in pairs]
+        for i in range(0, 40, 4):
+            self.assertEqual(secrets[i:i + 4], list(range(secrets[i], secrets[i] + 4)))
+        self.assertTrue(all(secrets[i + 1] != secrets[i] + 1 for i in range(3, 39, 4)))
+        with self.assertRaises(ValueError):
+            find('10', None, 1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or (sys.argv[1] == '-n') != (len(sys.argv) == 3):
+        sys.exit(USAGE)
+    workers = os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if sys.argv[1] == '-n':
+            count = int(sys.argv[2])
+            started = perf_counter()
+            for secret, address in generate(count, executor):
+                print('{:064x} {}'.format(secret, address))
+            seconds = perf_counter() - started
+        else:
+            secret, address, count, seconds = find(sys.argv[1], executor, workers)
+            print('{:064x} {}'.format(secret, address))
+        print('{} keys in {:.1f}s, {:.0f} keys/sec'.format(count, seconds, count / seconds),
+              file=sys.stderr)